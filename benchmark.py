@@ -0,0 +1,288 @@
+import argparse
+from dataclasses import dataclass, field
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import tabulate
+
+import counter
+import distribute
+import timesheet
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--scales", type=int, nargs="+", default=[1, 5, 20, 100],
+                    help="sizes of the synthetic instances, multiples of the example instance")
+parser.add_argument("--cases", type=str, nargs="+", default=None,
+                    help="cases to run (default: all)")
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--repeat", type=int, default=3,
+                    help="runs of each case, the fastest one is compared")
+parser.add_argument("--time-limit", type=float, default=5,
+                    help="CP-SAT time limit of the solve case in seconds (deterministic time)")
+parser.add_argument("--full", action="store_true",
+                    help="run every case at every scale, even those too slow for a quick run")
+parser.add_argument("--output", type=str, default="benchmark.json")
+parser.add_argument("--baseline", type=str, default=None,
+                    help="results of an earlier run to compare with")
+parser.add_argument("--tolerance", type=float, default=0.2,
+                    help="relative slowdown against the baseline reported as a regression")
+
+
+BASE_KRUHY = 40
+BASE_TEAMS = 10
+BASE_ACTIVITIES = 10
+SUBTEAMS = [("1", "#F08080"), ("2", "#98FB98"), ("3", "#87CEFA"), ("4", "#fff491")]
+SUBTEAM_SIZES = [10, 8]
+REGRESSION_MIN_DIFFERENCE = 0.005  # seconds, differences of the fastest cases below are noise
+ACTIVITY_TYPES = ["all", "split", "split", "rest", "all", "split", "split", "rest", "split", "all"]
+
+
+@dataclass
+class Instance:
+    scale: int
+    counts: dict[int, int]
+    config: dict
+    directory: str
+    kruhy: list[distribute.Kruh] = field(default_factory=list)
+    num_teams: int = 0  # Teams of the distribute cases, enough for the smaller Subteam size
+    time_limit: float = 5  # CP-SAT time limit of the solve case
+
+
+# GENERATOR ============================================================================================================
+
+def generate_counts(scale: int, rng: random.Random) -> dict[int, int]:
+    # - Mostly small Kruhy as in the example, a few large ones split by every Subteam size
+    counts = {}
+    for kruh in range(1, BASE_KRUHY * scale + 1):
+        counts[kruh] = rng.randint(14, 30) if rng.random() < 0.05 else rng.randint(1, 13)
+    return counts
+
+
+def generate_config(counts: dict[int, int], scale: int, rng: random.Random) -> dict:
+    # - Obory are fixed by distribute.Obor, only the Kruhy in them scale
+    kruhy_obory = {obor: [] for obor in distribute.Obor}
+    for kruh in counts:
+        kruhy_obory[rng.choice(list(distribute.Obor))].append(kruh)
+
+    num_people = sum(counts.values())
+    num_teams = math.ceil(num_people / (len(SUBTEAMS) * min(SUBTEAM_SIZES) * 0.85))
+    num_timetable_teams = BASE_TEAMS * scale
+    num_activities = BASE_ACTIVITIES * scale
+
+    return {
+        "Teams count": num_timetable_teams,
+        "Possible Teams counts": [num_teams, num_teams + 1],
+        "Possible Teams sizes": SUBTEAM_SIZES,
+        "Teams names": [f"Team {i_team + 1}" for i_team in range(max(num_timetable_teams, num_teams + 1))],
+        "Subteams count": len(SUBTEAMS),
+        "Subteams": [{"Name": name, "Color": color} for name, color in SUBTEAMS],
+        "Activities count": num_activities,
+        "Activities": [{"Name": f"Activity {i_activity + 1}", "Type": ACTIVITY_TYPES[i_activity % len(ACTIVITY_TYPES)]}
+                       for i_activity in range(num_activities)],
+        "Time": {"Start": "13:00", "Activity duration": "00:15"},
+        "Obory": [{"Name": str(obor), "Kruhy": kruhy} for obor, kruhy in kruhy_obory.items()],
+    }
+
+
+def generate_instance(scale: int, seed: int, directory: str) -> Instance:
+    rng = random.Random(seed * 1000 + scale)
+    counts = generate_counts(scale, rng)
+    config = generate_config(counts, scale, rng)
+    instance = Instance(scale, counts, config, directory)
+    instance.kruhy = distribute.make_kruhy(counts, config)
+    instance.num_teams = config["Possible Teams counts"][0]
+    return instance
+
+
+def spread_distribution(instance: Instance, max_subteam_size: int) -> distribute.Solution:
+    # - Kruhy dealt round-robin, the output does not check the capacity
+    kruhy_split, _ = distribute.compute_kruhy_split(instance.kruhy, max_subteam_size)
+    num_subteams = instance.config["Subteams count"]
+    distribution = [[[] for _ in range(num_subteams)] for _ in range(instance.num_teams)]
+    for i_kruh, kruh in enumerate(kruhy_split):
+        team, subteam = divmod(i_kruh % (instance.num_teams * num_subteams), num_subteams)
+        distribution[team][subteam].append(kruh)
+    return distribute.Solution(instance.num_teams, max_subteam_size, distribute.Solution.Status.FEASIBLE, distribution,
+                               time=0, objective=0, bound=0)
+
+# CASES ================================================================================================================
+
+def bench_split(instance: Instance) -> dict:
+    for max_subteam_size in SUBTEAM_SIZES:
+        distribute.compute_kruhy_split(instance.kruhy, max_subteam_size)
+    return {"kruhy": len(instance.kruhy)}
+
+
+def bench_build(instance: Instance, formulation: distribute.Formulation) -> dict:
+    max_subteam_size = min(SUBTEAM_SIZES)
+    kruhy_split, kruhy_friends = distribute.compute_kruhy_split(instance.kruhy, max_subteam_size)
+    build_model = distribute.MODEL_BUILDERS[formulation]
+    dmodel = build_model(instance.num_teams, instance.config["Subteams count"], max_subteam_size, kruhy_split, kruhy_friends)
+    num_variables, num_constraints = dmodel.size()
+    return {"variables": num_variables, "constraints": num_constraints}
+
+
+def bench_build_element(instance: Instance) -> dict:
+    return bench_build(instance, distribute.Formulation.ELEMENT)
+
+
+def bench_build_compact(instance: Instance) -> dict:
+    return bench_build(instance, distribute.Formulation.COMPACT)
+
+
+def bench_solve(instance: Instance, options: distribute.SolverOptions) -> dict:
+    max_subteam_size = min(SUBTEAM_SIZES)
+    kruhy_split, kruhy_friends = distribute.compute_kruhy_split(instance.kruhy, max_subteam_size)
+    # - Every run builds its own model
+    distribute._parametric_models.clear()
+    solution = distribute.ENGINES[options.engine](instance.num_teams, max_subteam_size, kruhy_split, kruhy_friends,
+                                                  instance.config, options)
+    return {"status": solution.status.name, "objective": solution.objective, "bound": solution.bound}
+
+
+def bench_solve_cpsat(instance: Instance) -> dict:
+    # - Deterministic, so that the same work is timed on every run
+    return bench_solve(instance, distribute.SolverOptions(time_limit=instance.time_limit,
+                                                          formulation=distribute.Formulation.COMPACT,
+                                                          profile=distribute.SolverProfile.DETERMINISTIC))
+
+
+def bench_solve_heuristic(instance: Instance) -> dict:
+    return bench_solve(instance, distribute.SolverOptions(engine=distribute.Engine.HEURISTIC))
+
+
+def bench_write_solutions(instance: Instance) -> dict:
+    solutions = [spread_distribution(instance, max_subteam_size) for max_subteam_size in SUBTEAM_SIZES]
+    filename = os.path.join(instance.directory, "distributions.xlsx")
+    distribute.write_solutions(filename, solutions, instance.config)
+    return {"bytes": os.path.getsize(filename)}
+
+
+def bench_construct_timetable(instance: Instance) -> dict:
+    filename = os.path.join(instance.directory, "timesheet.xlsx")
+    timesheet.construct_timetable(filename, instance.config)
+    return {"bytes": os.path.getsize(filename)}
+
+
+def bench_counter_save_load(instance: Instance) -> dict:
+    filename = os.path.join(instance.directory, "counts.json")
+    counter.save_data(instance.counts, filename)
+    data = counter.load_data(filename)
+    return {"kruhy": len(data)}
+
+
+# - name -> (case, largest scale of a quick run)
+CASES = {
+    "split": (bench_split, 100),
+    "build_element": (bench_build_element, 1),
+    "build_compact": (bench_build_compact, 5),
+    "solve_cpsat": (bench_solve_cpsat, 1),
+    "solve_heuristic": (bench_solve_heuristic, 20),
+    "write_solutions": (bench_write_solutions, 100),
+    "construct_timetable": (bench_construct_timetable, 20),
+    "counter_save_load": (bench_counter_save_load, 100),
+}
+
+# RUNNING ==============================================================================================================
+
+def run_case(case, instance: Instance, repeat: int) -> dict:
+    times = []
+    info = None
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        info = case(instance)
+        times.append(time.perf_counter() - t_start)
+    return {
+        "scale": instance.scale,
+        "best": min(times),
+        "median": statistics.median(times),
+        "times": times,
+        "info": info,
+    }
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    names = args.cases or list(CASES)
+    for name in names:
+        if name not in CASES:
+            print(f"Unknown case [{name}], choose from: {', '.join(CASES)}")
+            sys.exit(1)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in args.scales:
+            instance = generate_instance(scale, args.seed, directory)
+            instance.time_limit = args.time_limit
+            print(f"Scale {scale}x: {len(instance.kruhy)} Kruhy, {sum(instance.counts.values())} people, "
+                  f"{instance.num_teams} Teams, {instance.config['Activities count']} activities")
+            for name in names:
+                case, max_scale = CASES[name]
+                if scale > max_scale and not args.full:
+                    continue
+                result = run_case(case, instance, args.repeat)
+                results[f"{name}@{scale}"] = result
+                print(f"> {name:<20} {result['best']:>9.4f}s  {result['info']}")
+
+    return {
+        "meta": {
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "time_limit": args.time_limit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare(benchmark: dict, baseline: dict, tolerance: float) -> list[str]:
+    rows = []
+    regressions = []
+    for key, result in benchmark["results"].items():
+        if key not in baseline["results"]:
+            continue
+        best, baseline_best = result["best"], baseline["results"][key]["best"]
+        ratio = best / baseline_best if baseline_best > 0 else math.inf
+        verdict = ""
+        if abs(best - baseline_best) < REGRESSION_MIN_DIFFERENCE:
+            pass
+        elif ratio > 1 + tolerance:
+            verdict = "REGRESSION"
+            regressions.append(key)
+        elif ratio < 1 - tolerance:
+            verdict = "faster"
+        rows.append([key, f"{baseline_best:.4f}", f"{best:.4f}", f"{ratio:.2f}x", verdict])
+
+    print(tabulate.tabulate(rows, headers=["Case", "Baseline [s]", "Current [s]", "Ratio", ""], tablefmt="simple"))
+    return regressions
+
+
+def main(args: argparse.Namespace):
+    benchmark = run_benchmark(args)
+    with open(args.output, "w", encoding="utf8") as file:
+        json.dump(benchmark, file, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding="utf8") as file:
+            baseline = json.load(file)
+        if baseline["meta"]["seed"] != args.seed:
+            print(f"Baseline was generated with seed {baseline['meta']['seed']}, instances differ")
+        regressions = compare(benchmark, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -1,12 +1,52 @@
 import argparse
+import bisect
+from dataclasses import dataclass, field
 import json
 import os
+import queue
+import re
+import shutil
+import socket
+import sys
+import threading
+import time
+import uuid
 
 import tabulate
 
+import instrument
+
 
 parser = argparse.ArgumentParser()
 parser.add_argument("file", type=str, nargs="?", default="counts.json")
+parser.add_argument("--journal", type=str, default=None,
+                    help="journal of the increments and undos (default: FILE.journal)")
+parser.add_argument("--plain", action="store_true",
+                    help="clear the screen and print the whole table after each input (default when not a terminal)")
+parser.add_argument("--station", type=str, default=socket.gethostname(),
+                    help="name of this counting station, recorded in the journal (default: the host name)")
+parser.add_argument("--connect", type=str, default=None,
+                    help="count on a counter_server.py at HOST:PORT or a Unix socket path, instead of into FILE")
+parser.add_argument("--batch", type=str, nargs="?", const="-", default=None,
+                    help="do not prompt, read the group numbers from this file or device (default: - for stdin)")
+parser.add_argument("--batch-size", type=int, default=1000,
+                    help="most lines read at once in batch mode, applied, saved and drawn together")
+parser.add_argument("--config", type=str, default=None,
+                    help="distribution config, in batch mode only the Kruhy of its Obory are accepted")
+instrument.add_arguments(parser)
+
+
+JOURNAL_FSYNC_RECORDS = 10  # records appended before they are forced to disk
+JOURNAL_FSYNC_INTERVAL = 1.0  # seconds, at most this much of counting is lost on a power loss
+JOURNAL_COMPACT_RECORDS = 500  # records after which the journal is compacted and the counts file written
+JOURNAL_COMPACT_INTERVAL = 10.0  # seconds, also how stale the counts file may get while counting
+HISTORY_KEPT = 1000  # increments which can still be undone after a compaction
+HISTORY_SHOWN = 15  # recent increments shown under the table, also sent by the server with each confirmation
+CLOSE_TIMEOUT = 2.0  # seconds to wait on exit for the server to confirm the last increments
+MESSAGE_OPS = 2000  # most increments and undos sent in one message, its line within the limit of the server
+TOKEN_SEPARATORS = re.compile(r"[\s,;]+")
+REJECTED_SHOWN = 20  # most frequent rejected tokens listed after a batch run
+TABLE_HEADERS = ["Group Number", "Visitor Count"]
 
 
 def load_data(filename: str) -> dict[int, int]:
@@ -19,21 +59,487 @@ def load_data(filename: str) -> dict[int, int]:
 
 
 def save_data(data, filename: str):
-    with open(filename, "w") as file:
+    # - Written aside and renamed, so that a crash never leaves a partly written file
+    with open(f"{filename}.tmp", "w") as file:
         json.dump(data, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    replace_durably(f"{filename}.tmp", filename)
+
+
+def replace_durably(source: str, destination: str):
+    os.replace(source, destination)
+    if os.name != "nt":
+        # - The rename itself survives a power loss only once the directory is synced
+        directory = os.open(os.path.dirname(os.path.abspath(destination)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+class Journal:
+    # - Write-ahead log of the counting: the first line is a snapshot {"id", "station", "seq", "counts", "history"},
+    #   each further line one increment or undo {"seq", "op", "group", "time"}, appended and flushed.
+    #   The records are synced in batches, and once enough of them pile up the journal is compacted
+    #   into a new snapshot (renamed over it) and the counts file is written for the other scripts.
+    #   A timer thread does both for the records left behind once the counting pauses.
+    #   The id stays with the journal through the compactions, its copies are told apart by the seq.
+    def __init__(self, filename: str, journal_filename: str = None, station: str = None):
+        self.filename = filename
+        self.journal_filename = journal_filename or f"{filename}.journal"
+        self.id = None
+        self.station = station
+        self.lock = threading.RLock()  # - held by the timer, and while drawing as with RemoteCounts
+        self.data: dict[int, int] = {}
+        self.history: list[int] = []
+        self.seq = 0
+        self.file = None
+        self.num_unsynced = 0
+        self.num_records = 0
+        self.t_synced = time.time()
+        self.t_compacted = time.time()
+        self.stopped = threading.Event()
+        self.timer: threading.Thread = None
+
+    def open(self):
+        if os.path.exists(self.journal_filename):
+            self.replay()
+        else:
+            # - Counts written before the journal existed, without their history
+            self.data = load_data(self.filename)
+        if self.id is None:
+            self.id = uuid.uuid4().hex
+        self.compact()
+        self.timer = threading.Thread(target=self.run_timer, daemon=True)
+        self.timer.start()
+
+    def run_timer(self):
+        # - Every record is synced within JOURNAL_FSYNC_INTERVAL and compacted within JOURNAL_COMPACT_INTERVAL,
+        #   even when no further record comes to do it
+        while not self.stopped.wait(JOURNAL_FSYNC_INTERVAL):
+            with self.lock:
+                if self.file is None:
+                    return
+                if self.num_unsynced > 0:
+                    self.sync()
+                if self.num_records > 1 and time.time() - self.t_compacted >= JOURNAL_COMPACT_INTERVAL:
+                    self.compact()
+
+    def replay(self, repair: bool = True):
+        with open(self.journal_filename, "rb") as file:
+            content = file.read()
+        good_end = 0
+        for line in content.splitlines(keepends=True):
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("incomplete record")
+                record = json.loads(line)
+            except ValueError:
+                # - A record torn by a crash or a power loss, it was never confirmed
+                break
+            good_end += len(line)
+            self.apply(record)
+        instrument.count("replayed records", self.num_records)
+        if good_end < len(content) and repair:
+            with open(self.journal_filename, "r+b") as file:
+                file.truncate(good_end)
+
+    def apply(self, record: dict):
+        if "counts" in record:
+            # - Journals written before the ids and stations have neither
+            self.id = record.get("id", self.id)
+            self.station = self.station or record.get("station")
+            self.data = {int(k): v for k, v in record["counts"].items()}
+            self.history = list(record["history"])
+        elif record["op"] == "+":
+            increment(record["group"], self.data, self.history)
+        elif record["op"] == "-":
+            undo_last_increment(self.data, self.history)
+        self.seq = record["seq"]
+        self.num_records += 1
+
+    def increment(self, group_num: int):
+        self.apply_ops([("+", group_num)])
+
+    def undo(self) -> int | None:
+        applied = self.apply_ops([("-", None)])
+        return applied[0][1] if applied else None
+
+    def apply_ops(self, ops: list[tuple[str, int | None]]) -> list[tuple[str, int]]:
+        # - Increments ("+", group) and undos ("-", None) appended at once, returns those applied with their groups
+        with self.lock:
+            applied = []
+            for op, group_num in ops:
+                if op == "+":
+                    increment(group_num, self.data, self.history)
+                elif self.history:
+                    group_num = self.history[-1]
+                    undo_last_increment(self.data, self.history)
+                else:
+                    continue
+                applied.append((op, group_num))
+            if applied:
+                self.append(applied)
+            return applied
+
+    def append(self, ops: list[tuple[str, int]]):
+        lines = []
+        t_now = round(time.time(), 3)
+        for op, group_num in ops:
+            self.seq += 1
+            lines.append(json.dumps({"seq": self.seq, "op": op, "group": group_num, "time": t_now}) + "\n")
+        self.file.write("".join(lines))
+        self.file.flush()
+        self.num_unsynced += len(ops)
+        self.num_records += len(ops)
+
+        # - The intervals are kept by the timer
+        if self.num_unsynced >= JOURNAL_FSYNC_RECORDS:
+            self.sync()
+        if self.num_records >= JOURNAL_COMPACT_RECORDS:
+            self.compact()
+
+    def sync(self):
+        with instrument.span("fsync"):
+            os.fsync(self.file.fileno())
+        self.num_unsynced = 0
+        self.t_synced = time.time()
+
+    def compact(self):
+        with instrument.span("compact"):
+            if self.file is not None:
+                self.file.close()
+            del self.history[:-HISTORY_KEPT]
+            snapshot = {"id": self.id, "station": self.station, "seq": self.seq, "counts": self.data,
+                        "history": self.history}
+            with open(f"{self.journal_filename}.tmp", "w") as file:
+                file.write(json.dumps(snapshot) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            replace_durably(f"{self.journal_filename}.tmp", self.journal_filename)
+            self.file = open(self.journal_filename, "a")
+            self.num_unsynced = 0
+            self.num_records = 1
+            self.t_synced = self.t_compacted = time.time()
+            save_data(self.data, self.filename)
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            if self.file is not None:
+                self.compact()
+                self.file.close()
+                self.file = None
+
+
+def parse_address(address: str) -> tuple[str, int] | str:
+    # - HOST:PORT of a TCP socket, anything else is the path of a Unix socket
+    host, _, port = address.rpartition(":")
+    if host and port.isascii() and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def connect(address: str) -> socket.socket:
+    target = parse_address(address)
+    if isinstance(target, str):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(target)
+    else:
+        client = socket.create_connection(target)
+        # - The messages are small and the pushed totals should not wait for more of them
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return client
+
+
+def encode_message(message: dict) -> bytes:
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode("utf8")
+
+
+class RemoteCounts:
+    # - Counting on counter_server.py, which owns the counts and the history of each station.
+    #   Increments and undos are shown at once and sent as {"id", "ops"}; while a message waits for its confirmation,
+    #   the following ones are batched into the next. The server pushes {"changes"} of the totals, made by any station,
+    #   with {"ack", "history"} of this station when confirming. The shown counts are the confirmed ones
+    #   with the unconfirmed increments and undos applied, the callback redraws them as they come.
+    def __init__(self, address: str, station: str):
+        self.address = address
+        self.station = station
+        self.lock = threading.Condition()
+        self.data: dict[int, int] = {}
+        self.history: list[int] = []
+        self.counts: dict[int, int] = {}  # confirmed by the server
+        self.confirmed_history: list[int] = []
+        self.sent: list[tuple[str, int | None]] = []  # waiting for the confirmation
+        self.pending: list[tuple[str, int | None]] = []  # batched into the next message
+        self.message_id = 0
+        self.socket: socket.socket = None
+        self.error: str = None
+        self.on_change = None  # called with the changed groups, under the lock
+
+    def open(self):
+        self.socket = connect(self.address)
+        self.socket.sendall(encode_message({"station": self.station}))
+        file = self.socket.makefile("rb")
+        state = json.loads(file.readline() or b"{}")
+        if "error" in state or "counts" not in state:
+            raise ConnectionError(state.get("error", "The server closed the connection"))
+        self.counts = {int(k): v for k, v in state["counts"].items()}
+        self.confirmed_history = state["history"]
+        self.data = dict(self.counts)
+        self.history = list(self.confirmed_history)
+        threading.Thread(target=self.receive, args=(file,), daemon=True).start()
+
+    def increment(self, group_num: int):
+        self.apply_ops([("+", group_num)])
+
+    def undo(self) -> int | None:
+        applied = self.apply_ops([("-", None)])
+        return applied[0][1] if applied else None
+
+    def apply_ops(self, ops: list[tuple[str, int | None]]) -> list[tuple[str, int]]:
+        # - The group of an undo is known from the shown history, the server undoes the same one of its own.
+        #   When the shown history runs out, the undo is sent anyway and shown once confirmed.
+        with self.lock:
+            if self.error is not None:
+                raise ConnectionError(self.error)
+            applied = []
+            for op, group_num in ops:
+                if op == "+":
+                    increment(group_num, self.data, self.history)
+                else:
+                    group_num = self.history[-1] if self.history else None
+                    undo_last_increment(self.data, self.history)
+                self.pending.append((op, group_num))
+                if group_num is not None:
+                    applied.append((op, group_num))
+            if self.pending and not self.sent:
+                self.send()
+            return applied
+
+    def send(self):
+        self.message_id += 1
+        self.sent, self.pending = self.pending[:MESSAGE_OPS], self.pending[MESSAGE_OPS:]
+        instrument.count("messages")
+        self.socket.sendall(encode_message({"id": self.message_id, "ops": [list(op) for op in self.sent]}))
+
+    def receive(self, file):
+        try:
+            for line in file:
+                self.update(json.loads(line))
+        except (OSError, ValueError) as e:
+            error = f"Connection to the server lost: {e}"
+        else:
+            error = "The server closed the connection"
+        with self.lock:
+            self.error = self.error or error
+            self.lock.notify_all()
+
+    def update(self, message: dict):
+        with self.lock:
+            changed = set()
+            for group, count in message.get("changes", {}).items():
+                changed.add(int(group))
+                if count > 0:
+                    self.counts[int(group)] = count
+                else:
+                    self.counts.pop(int(group), None)
+            if "ack" in message:
+                changed.update(group_num for _, group_num in self.sent if group_num is not None)
+                self.confirmed_history = message["history"]
+                self.sent = []
+            self.refresh(changed)
+            if "ack" in message:
+                if self.pending:
+                    self.send()
+                self.lock.notify_all()
+
+    def refresh(self, changed: set[int]):
+        unconfirmed = self.sent + self.pending
+        for group_num in changed:
+            count = self.counts.get(group_num, 0)
+            count += sum((1 if op == "+" else -1) for op, op_group in unconfirmed if op_group == group_num)
+            if count > 0:
+                self.data[group_num] = count
+            else:
+                self.data.pop(group_num, None)
+        self.history = list(self.confirmed_history)
+        for op, group_num in unconfirmed:
+            if op == "+":
+                self.history.append(group_num)
+            elif self.history:
+                self.history.pop()
+        if self.on_change is not None:
+            self.on_change(changed)
+
+    def close(self):
+        if self.socket is None:
+            return
+        with self.lock:
+            self.lock.wait_for(lambda: not self.sent or self.error is not None, CLOSE_TIMEOUT)
+            if self.sent and self.error is None:
+                print(f"{len(self.sent) + len(self.pending)} increments or undos not confirmed by the server")
+        self.socket.close()
+        self.socket = None
 
 
 def print_data(data: dict[int, int], history: list[int]):
     os.system('cls' if os.name == 'nt' else 'clear')
 
-    table_headers = ["Group Number", "Visitor Count"]
     table_data = sorted([[group, count] for group, count in data.items()])
     table_data += [["Total", sum(data.values())]]
 
-    print(tabulate.tabulate(table_data, headers=table_headers, tablefmt="simple"))
+    print(tabulate.tabulate(table_data, headers=TABLE_HEADERS, tablefmt="simple"))
 
     print("\nRecent Changes:")
-    print(" ".join(map(str, history[-15:])))
+    print(" ".join(map(str, history[-HISTORY_SHOWN:])))
+
+
+class PlainRenderer:
+    def mark(self, group_num: int):
+        pass
+
+    def render(self, data: dict[int, int], history: list[int]):
+        print_data(data, history)
+
+    def render_live(self, data: dict[int, int], history: list[int]):
+        pass
+
+
+class Renderer:
+    # - Keeps the table on the screen and rewrites only the rows of the marked groups, the total and the history
+    #   through ANSI escape sequences. Only a group appearing or disappearing moves the rows below it.
+    #   When the groups do not fit the terminal, a window of them is shown, following the changes.
+    FIXED_LINES = 8  # header, separator, total, blank, history title, history, prompt and the line below it
+
+    def __init__(self):
+        self.groups: list[int] = []  # shown groups, sorted
+        self.counts: dict[int, int] = {}  # shown counts
+        self.total = 0
+        self.top = 0  # index of the first shown group
+        self.size = None  # terminal size, a change redraws everything
+        self.marked: set[int] = set()
+        self.output: list[str] = []
+        if os.name == "nt":
+            os.system("")  # - enables the escape sequences in the Windows console
+
+    def mark(self, group_num: int):
+        self.marked.add(group_num)
+
+    def render(self, data: dict[int, int], history: list[int]):
+        size = shutil.get_terminal_size()
+        if size != self.size:
+            self.size = size
+            self.groups = sorted(data)
+            self.counts = dict(data)
+            self.total = sum(data.values())
+            self.output.append("\x1b[2J")
+            self.draw_header()
+            self.draw_rows(0)
+        else:
+            for group_num in sorted(self.marked):
+                self.update(group_num, data.get(group_num, 0))
+        self.marked.clear()
+        self.draw_footer(history)
+        sys.stdout.write("\x1b[?25l" + "".join(self.output) + "\x1b[?25h")
+        sys.stdout.flush()
+        instrument.count("escape sequences", len(self.output))
+        self.output.clear()
+
+    def render_live(self, data: dict[int, int], history: list[int]):
+        # - Changes pushed while the prompt waits for input: the rows are rewritten in place and the cursor put back,
+        #   keeping what was typed. A group appearing or disappearing would move the rows, it waits for the input.
+        if self.size != shutil.get_terminal_size():
+            return
+        in_place = {group_num for group_num in self.marked if (data.get(group_num, 0) > 0) == (group_num in self.counts)}
+        for group_num in sorted(in_place):
+            self.update(group_num, data.get(group_num, 0))
+        self.marked -= in_place
+        self.draw_total()
+        self.draw_history(history)
+        sys.stdout.write("\x1b7\x1b[?25l" + "".join(self.output) + "\x1b8\x1b[?25h")
+        sys.stdout.flush()
+        self.output.clear()
+
+    def update(self, group_num: int, count: int):
+        self.total += count - self.counts.get(group_num, 0)
+        index = bisect.bisect_left(self.groups, group_num)
+        present = index < len(self.groups) and self.groups[index] == group_num
+        if count > 0:
+            self.counts[group_num] = count
+        else:
+            self.counts.pop(group_num, None)
+
+        if count > 0 and present:
+            if self.scroll_to(index):
+                self.draw_header()
+                self.draw_rows(self.top)
+            else:
+                self.draw_row(index)
+            return
+        if count > 0:
+            self.groups.insert(index, group_num)
+        elif present:
+            del self.groups[index]
+        else:
+            return
+        moved = self.scroll_to(min(index, len(self.groups) - 1))
+        self.draw_header()
+        self.draw_rows(self.top if moved else index)
+
+    def visible(self) -> int:
+        return max(1, self.size.lines - Renderer.FIXED_LINES)
+
+    def shown(self) -> int:
+        return min(len(self.groups), self.visible())
+
+    def scroll_to(self, index: int) -> bool:
+        # - The window moves the least to show the row, returns whether it moved
+        top = min(max(self.top, index - self.visible() + 1), max(index, 0))
+        top = max(0, min(top, len(self.groups) - self.shown()))
+        moved = top != self.top
+        self.top = top
+        return moved
+
+    def line(self, row: int, text: str):
+        self.output.append(f"\x1b[{row};1H\x1b[2K{text[:self.size.columns - 1]}")
+
+    def draw_header(self):
+        widths = [len(header) for header in TABLE_HEADERS]
+        window = ""
+        if len(self.groups) > self.shown():
+            window = f"  ({self.top + 1}-{self.top + self.shown()} of {len(self.groups)})"
+        self.line(1, "  ".join(TABLE_HEADERS))
+        self.line(2, "  ".join("-" * width for width in widths) + window)
+
+    def draw_row(self, index: int):
+        if not self.top <= index < self.top + self.shown():
+            return
+        group_num = self.groups[index]
+        self.line(3 + index - self.top, f"{group_num:>{len(TABLE_HEADERS[0])}}  {self.counts[group_num]:>{len(TABLE_HEADERS[1])}}")
+
+    def draw_rows(self, start: int):
+        # - The rows from start to the bottom of the window, and everything under the table, which may have moved
+        for index in range(max(start, self.top), self.top + self.shown()):
+            self.draw_row(index)
+        row_total = 3 + self.shown()
+        self.line(row_total + 1, "")
+        self.line(row_total + 2, "Recent Changes:")
+
+    def draw_total(self):
+        self.line(3 + self.shown(), f"{'Total':<{len(TABLE_HEADERS[0])}}  {self.total:>{len(TABLE_HEADERS[1])}}")
+
+    def draw_history(self, history: list[int]):
+        # - The most recent changes which fit the line
+        recent = " ".join(map(str, history[-HISTORY_SHOWN:]))
+        self.line(3 + self.shown() + 3, recent[max(0, len(recent) - self.size.columns + 1):])
+
+    def draw_footer(self, history: list[int]):
+        self.draw_total()
+        self.draw_history(history)
+        # - The prompt is printed by input() from here, the rest of the screen is cleared
+        self.output.append(f"\x1b[{3 + self.shown() + 4};1H\x1b[J")
 
 
 def increment(group_num: int, data: dict[int, int], history: list[int]):
@@ -54,35 +560,180 @@ def undo_last_increment(data: dict[int, int], history: list[int]):
             del data[last_group]
 
 
-def input_loop(data: dict[int, int], history: list[int]):
-    print_data(data, history)
+def input_loop(journal: Journal | RemoteCounts, renderer: Renderer | PlainRenderer):
+    with instrument.span("print"), journal.lock:
+        renderer.render(journal.data, journal.history)
 
-    user_input = input("Enter group number to increment or '-' to undo: ").strip()
+    with instrument.span("input"):
+        user_input = input("Enter group number to increment or '-' to undo: ").strip()
 
     if user_input == "-":
-        undo_last_increment(data, history)
+        with instrument.span("save"):
+            group_num = journal.undo()
+        if group_num is not None:
+            renderer.mark(group_num)
+        instrument.count("undos")
         return True
-    elif user_input.isdigit():
+    elif user_input.isascii() and user_input.isdigit():
         group_num = int(user_input)
-        increment(group_num, data, history)
+        with instrument.span("save"):
+            journal.increment(group_num)
+        renderer.mark(group_num)
+        instrument.count("increments")
         return True
 
     return False
 
 
+@dataclass
+class BatchStats:
+    lines: int = 0
+    tokens: int = 0
+    increments: int = 0
+    undos: int = 0
+    batches: int = 0
+    rejected: dict[str, list[int]] = field(default_factory=dict)  # token -> numbers of the lines
+    t_start: float = field(default_factory=time.time)
+
+    def status(self) -> str:
+        elapsed = time.time() - self.t_start
+        rate = self.tokens / elapsed if elapsed > 0 else 0
+        num_rejected = sum(len(line_nums) for line_nums in self.rejected.values())
+        return (f"{self.tokens} tokens from {self.lines} lines in {elapsed:.2f}s ({rate:.0f} tokens/s, "
+                f"{self.batches} batches): {self.increments} increments, {self.undos} undos, {num_rejected} rejected")
+
+
+def load_kruhy(config_file: str) -> set[int]:
+    with open(config_file, "r", encoding="utf8") as file:
+        config = json.load(file)
+    return {kruh for obor in config["Obory"] for kruh in obor["Kruhy"]}
+
+
+def parse_tokens(line: str, kruhy: set[int] | None) -> tuple[list[tuple[str, int | None]], list[str]]:
+    ops = []
+    rejected = []
+    for token in TOKEN_SEPARATORS.split(line.strip()):
+        if token == "-":
+            ops.append(("-", None))
+        elif token.isascii() and token.isdigit() and (kruhy is None or int(token) in kruhy):
+            ops.append(("+", int(token)))
+        elif token:
+            rejected.append(token)
+    return ops, rejected
+
+
+def read_lines(file, lines: queue.Queue):
+    # - Read apart from the counting, the lines arriving meanwhile make the next batch
+    try:
+        for line in file:
+            lines.put(line)
+    finally:
+        lines.put(None)
+        if file is not sys.stdin:
+            file.close()
+
+
+def batch_loop(journal: Journal | RemoteCounts, renderer: Renderer | PlainRenderer, source,
+               kruhy: set[int] | None, batch_size: int, stats: BatchStats):
+    # - A line waited for starts the batch, the lines already read are added to it. A scanner gets each scan
+    #   applied at once, a pasted list or a file is applied in batches, saved and drawn once each.
+    lines = queue.Queue()
+    threading.Thread(target=read_lines, args=(source, lines), daemon=True).start()
+    while True:
+        batch = [lines.get()]
+        while batch[-1] is not None and len(batch) < batch_size:
+            try:
+                batch.append(lines.get_nowait())
+            except queue.Empty:
+                break
+        ops = []
+        for line in batch:
+            if line is None:
+                break
+            stats.lines += 1
+            line_ops, rejected = parse_tokens(line, kruhy)
+            ops += line_ops
+            stats.tokens += len(line_ops) + len(rejected)
+            for token in rejected:
+                stats.rejected.setdefault(token, []).append(stats.lines)
+
+        with instrument.span("save"):
+            applied = journal.apply_ops(ops)
+        for _, group_num in applied:
+            renderer.mark(group_num)
+        stats.increments += sum(op == "+" for op, _ in applied)
+        stats.undos += sum(op == "-" for op, _ in applied)
+        stats.batches += 1
+        instrument.count("batches")
+        with instrument.span("print"), journal.lock:
+            renderer.render(journal.data, journal.history)
+        print(stats.status())
+        if batch[-1] is None:
+            return
+
+
+def report_batch(stats: BatchStats):
+    print(f"Done: {stats.status()}")
+    if not stats.rejected:
+        return
+    print(f"Rejected tokens, {len(stats.rejected)} distinct, the most frequent first:")
+    rejected = sorted(stats.rejected.items(), key=lambda item: -len(item[1]))[:REJECTED_SHOWN]
+    print(tabulate.tabulate([[token, len(line_nums), " ".join(map(str, line_nums[:10]))] for token, line_nums in rejected],
+                            headers=["Token", "Count", "Lines"], tablefmt="simple", disable_numparse=True))
+
+
 def main(args: argparse.Namespace):
-    data = load_data(args.file)
-    history = []
+    renderer = PlainRenderer() if args.plain or not sys.stdout.isatty() else Renderer()
+    if args.connect is not None:
+        journal = RemoteCounts(args.connect, args.station)
+        try:
+            journal.open()
+        except OSError as e:
+            print(f"Cannot connect to [{args.connect}]: {e}")
+            sys.exit(1)
+
+        def on_change(groups: set[int]):
+            for group_num in groups:
+                renderer.mark(group_num)
+            renderer.render_live(journal.data, journal.history)
+
+        journal.on_change = on_change
+    else:
+        journal = Journal(args.file, args.journal, args.station)
+        with instrument.span("load"):
+            journal.open()
+
+    stats = None
+    if args.batch is not None:
+        try:
+            source = sys.stdin if args.batch == "-" else open(args.batch, "r", encoding="utf8", errors="replace")
+        except OSError as e:
+            print(f"Cannot read [{args.batch}]: {e}")
+            journal.close()
+            sys.exit(1)
+        kruhy = load_kruhy(args.config) if args.config is not None else None
+        stats = BatchStats()
 
     try:
-        while True:
-            did_change = input_loop(data, history)
-            if did_change:
-                save_data(data, args.file)
-    except:
-        save_data(data, args.file)
+        if stats is not None:
+            batch_loop(journal, renderer, source, kruhy, args.batch_size, stats)
+        else:
+            while True:
+                input_loop(journal, renderer)
+    except (KeyboardInterrupt, EOFError):
+        pass
+    except ConnectionError as e:
+        print(e)
+    finally:
+        journal.close()
+        if stats is not None:
+            report_batch(stats)
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    main(args)
+    instrument.start(args)
+    try:
+        main(args)
+    finally:
+        instrument.finish()
@@ -0,0 +1,225 @@
+import argparse
+import asyncio
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+import tabulate
+
+import counter
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("file", type=str, nargs="?", default="counts.json",
+                    help="counts of all the stations together, written for the other scripts")
+parser.add_argument("--listen", type=str, default="127.0.0.1:8766",
+                    help="HOST:PORT to listen on, or the path of a Unix socket")
+parser.add_argument("--stations-dir", type=str, default=None,
+                    help="directory of the station journals (default: FILE.stations)")
+parser.add_argument("--merge", type=str, nargs="+", default=None,
+                    help="do not serve, merge these journals (or directories of them) into FILE")
+
+
+STATION_PATTERN = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9_.-]{0,63}")
+
+
+# SERVER ===============================================================================================================
+
+class CountingServer:
+    # - Owns the counts: every station has its journal, as counter.py keeps one, and the totals are their sum.
+    #   The messages of all the clients handled in one turn of the event loop are answered together,
+    #   with one push of the changed totals, so a busy server sends less, larger messages.
+    def __init__(self, filename: str, stations_dir: str):
+        self.filename = filename
+        self.stations_dir = stations_dir
+        self.journals: dict[str, counter.Journal] = {}
+        self.totals: dict[int, int] = {}
+        self.clients: dict[asyncio.StreamWriter, str] = {}  # -> station
+        self.changes: dict[int, int] = {}  # changed totals not yet pushed
+        self.acks: dict[asyncio.StreamWriter, int] = {}  # -> id of the last message handled
+        self.flush_scheduled = False
+        self.save_scheduled = False
+        self.t_saved = time.time()
+
+    def open(self):
+        os.makedirs(self.stations_dir, exist_ok=True)
+        for journal_filename in sorted(glob.glob(os.path.join(self.stations_dir, "*.journal"))):
+            journal = self.journal(os.path.basename(journal_filename).removesuffix(".journal"))
+            print(f"> Station [{journal.station}]: {sum(journal.data.values())} counted")
+        counter.save_data(self.totals, self.filename)
+
+    def journal(self, station: str) -> counter.Journal:
+        if station not in self.journals:
+            journal = counter.Journal(os.path.join(self.stations_dir, f"{station}.json"),
+                                      os.path.join(self.stations_dir, f"{station}.journal"), station)
+            journal.open()
+            self.journals[station] = journal
+            for group_num, count in journal.data.items():
+                self.totals[group_num] = self.totals.get(group_num, 0) + count
+        return self.journals[station]
+
+    def apply(self, journal: counter.Journal, ops: list):
+        # - The operations of a message are appended to the journal at once
+        checked = []
+        for op in ops:
+            if op[0] == "+" and isinstance(op[1], int) and op[1] >= 0:
+                checked.append(("+", op[1]))
+            elif op[0] == "-":
+                checked.append(("-", None))
+            else:
+                raise ValueError(f"Unknown operation {op}")
+        for op, group_num in journal.apply_ops(checked):
+            count = self.totals.get(group_num, 0) + (1 if op == "+" else -1)
+            if count > 0:
+                self.totals[group_num] = count
+            else:
+                del self.totals[group_num]
+            self.changes[group_num] = count
+        if self.changes and not self.save_scheduled:
+            # - The totals are written as often as the journals compact, the journals sync themselves
+            self.save_scheduled = True
+            delay = max(0.0, self.t_saved + counter.JOURNAL_COMPACT_INTERVAL - time.time())
+            asyncio.get_running_loop().call_later(delay, self.save)
+
+    def schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        for writer, station in self.clients.items():
+            message = {"changes": self.changes} if self.changes else {}
+            if writer in self.acks:
+                message |= {"ack": self.acks[writer],
+                            "history": self.journals[station].history[-counter.HISTORY_SHOWN:]}
+            if message:
+                writer.write(counter.encode_message(message))
+        self.changes = {}
+        self.acks.clear()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername") or "local"
+        try:
+            station = json.loads(await reader.readline() or b"{}").get("station")
+            if not isinstance(station, str) or not STATION_PATTERN.fullmatch(station):
+                writer.write(counter.encode_message({"error": f"Invalid station name {station!r}"}))
+                return
+            journal = self.journal(station)
+            writer.write(counter.encode_message({"counts": self.totals,
+                                                 "history": journal.history[-counter.HISTORY_SHOWN:]}))
+            self.clients[writer] = station
+            print(f"> Station [{station}] connected from {peer}, {len(self.clients)} connected")
+
+            while line := await reader.readline():
+                message = json.loads(line)
+                self.apply(journal, message["ops"])
+                self.acks[writer] = message["id"]
+                self.schedule_flush()
+                await writer.drain()
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            print(f"> Invalid message from {peer}: {e}")
+        except ConnectionError:
+            pass
+        finally:
+            if self.clients.pop(writer, None) is not None:
+                print(f"> Station [{station}] disconnected, {len(self.clients)} connected")
+            self.acks.pop(writer, None)
+            writer.close()
+
+    def save(self):
+        counter.save_data(self.totals, self.filename)
+        self.save_scheduled = False
+        self.t_saved = time.time()
+
+    def close(self):
+        for journal in self.journals.values():
+            journal.close()
+        self.save()
+
+
+async def serve(server: CountingServer, address: str):
+    target = counter.parse_address(address)
+    if isinstance(target, str):
+        listener = await asyncio.start_unix_server(server.handle, target)
+    else:
+        listener = await asyncio.start_server(server.handle, *target)
+    print(f"Counting on {address}, {sum(server.totals.values())} counted by {len(server.journals)} stations")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        if isinstance(target, str) and os.path.exists(target):
+            os.remove(target)
+
+# MERGING ==============================================================================================================
+
+def find_journals(paths: list[str]) -> list[str]:
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames += sorted(glob.glob(os.path.join(path, "*.journal")))
+        else:
+            filenames.append(path)
+    return filenames
+
+
+def merge_journals(filenames: list[str]) -> dict[int, int]:
+    # - Copies of one journal (taken at different times, or the same file given twice) share its id,
+    #   only the copy furthest in its sequence is counted. Journals of the same station made apart are all counted.
+    latest: dict[str, counter.Journal] = {}
+    rows = []
+    for filename in filenames:
+        journal = counter.Journal(None, filename)
+        try:
+            journal.replay(repair=False)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Skipping [{filename}]: {e}")
+            continue
+        # - Journals written before the ids are told apart by their path
+        journal.id = journal.id or os.path.abspath(filename)
+        rows.append(journal)
+        if journal.id not in latest or journal.seq > latest[journal.id].seq:
+            latest[journal.id] = journal
+        elif journal.seq == latest[journal.id].seq and journal.data != latest[journal.id].data:
+            print(f"Journals [{latest[journal.id].journal_filename}] and [{filename}] differ at the same record")
+
+    totals = {}
+    for journal in latest.values():
+        for group_num, count in journal.data.items():
+            totals[group_num] = totals.get(group_num, 0) + count
+
+    print(tabulate.tabulate([[journal.journal_filename, journal.station or "-", journal.seq, sum(journal.data.values()),
+                              "merged" if latest[journal.id] is journal else "copy"]
+                             for journal in rows],
+                            headers=["Journal", "Station", "Seq", "Counted", ""], tablefmt="simple", disable_numparse=True))
+    return totals
+
+
+def main(args: argparse.Namespace):
+    if args.merge is not None:
+        filenames = find_journals(args.merge)
+        if not filenames:
+            print("No journals found")
+            sys.exit(1)
+        totals = merge_journals(filenames)
+        counter.save_data(totals, args.file)
+        print(f"{sum(totals.values())} counted in {len(totals)} groups written to [{args.file}]")
+        return
+
+    server = CountingServer(args.file, args.stations_dir or f"{args.file}.stations")
+    server.open()
+    try:
+        asyncio.run(serve(server, args.listen))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
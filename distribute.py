@@ -1,27 +1,170 @@
 from __future__ import annotations
 import argparse
+import hashlib
 from collections import defaultdict
-from dataclasses import dataclass
+import concurrent.futures
+import csv
+from dataclasses import dataclass, field, replace
 from enum import Enum, StrEnum, auto
+import functools
 import itertools
 import json
+import math
+import multiprocessing
 import os
 import sys
+import tempfile
+import threading
 import time
 
-from ortools.sat.python import cp_model
-import xlsxwriter
-import xlsxwriter.worksheet
-import xlsxwriter.exceptions
+import instrument
+from lazy import lazy_import
+
+cp_model = lazy_import("ortools.sat.python.cp_model")
+xlsxwriter = lazy_import("xlsxwriter")
 
 
 SOLVER_TIME_LIMIT = 30  # seconds
+SCHEDULE_PROBE_SHARE = 0.3  # share of the time budget for probing all the grid points
+SCHEDULE_MIN_SLICE = 2  # seconds
+SCHEDULE_COMPETITIVE_MARGIN = 0.25  # points this much worse than the best objective are not refined
+PARAMETRIC_MODELS_CACHED = 8  # built models kept per process, see build_model_parametric
+MODEL_VERSION = 3  # increment when a change of the models changes their solutions, invalidates cached solutions
+SNAPSHOT_VERSION = 1  # increment when the snapshot metadata changes
+SNAPSHOT_HARD_TIME = 5  # seconds, with --snapshot-hard points proven optimal faster are not snapshotted
+WATCH_DEBOUNCE_LIMIT = 5  # debounce periods after which a burst of counts changes is solved even if it goes on
+
+
+class Formulation(StrEnum):
+    ELEMENT = auto()  # integer Team/Subteam variables channeled to booleans through element constraints
+    COMPACT = auto()  # boolean (Kruh, Team, Subteam) assignment only, linear symmetry breaking
+
+
+class Objective(StrEnum):
+    SUM = auto()  # Teams count plus Obory of all Teams, minimized at once
+    LEXICOGRAPHIC = auto()  # Teams count first, then Obory, then Subteams balance, each stage fixing the previous ones
+
+
+class SolverProfile(StrEnum):
+    DEFAULT = auto()  # CP-SAT defaults
+    FAST = auto()  # quick first solutions, light presolve and no LP relaxation
+    THOROUGH = auto()  # full portfolio with the strongest relaxation, for the best bounds, logs the search
+    DETERMINISTIC = auto()  # interleaved search limited by deterministic time, reproducible between runs
+
+
+# - CP-SAT parameters of each profile, the search workers are set by make_solver
+SOLVER_PROFILES = {
+    SolverProfile.DEFAULT: {},
+    SolverProfile.FAST: {
+        "random_seed": 1,
+        "interleave_search": False,
+        "linearization_level": 0,
+        "max_presolve_iterations": 1,
+        "log_search_progress": False,
+    },
+    SolverProfile.THOROUGH: {
+        "random_seed": 1,
+        "interleave_search": False,
+        "linearization_level": 2,
+        "log_search_progress": True,
+    },
+    SolverProfile.DETERMINISTIC: {
+        "random_seed": 1,
+        "interleave_search": True,
+        "log_search_progress": False,
+    },
+}
+
+# - Most search workers of a profile, fewer when the cores (divided among --jobs) are fewer; the others use all the cores
+PROFILE_MAX_WORKERS = {
+    SolverProfile.FAST: 8,
+    SolverProfile.DETERMINISTIC: 8,
+}
+
+
+class Engine(StrEnum):
+    CPSAT = auto()  # CP-SAT model, see Formulation
+    HEURISTIC = auto()  # Obor-aware first-fit decreasing packing with local search, no optimality proof
+    HYBRID = auto()  # CP-SAT starting from the heuristic solution, bounded by its objective
+    DECOMPOSED = auto()  # CP-SAT assigning Kruhy to Teams, then packing each Team into Subteams independently
+
+
+class OutputFormat(StrEnum):
+    XLSX = auto()  # workbook with the Summary and two worksheets per distribution
+    JSON = auto()  # all the distributions in one JSON document, as --json
+    JSONL = auto()  # one distribution per line
+    CSV = auto()  # one row per Kruh of each distribution, see CSV_HEADER
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--config", type=str, default="config.json")
 parser.add_argument("--counts", type=str, default="counts.json")
 parser.add_argument("--output", type=str, default="distributions.xlsx")
+parser.add_argument("--jobs", type=int, default=1,
+                    help="number of grid points solved concurrently (processes)")
+parser.add_argument("--threads", type=int, default=None,
+                    help="CP-SAT search workers per grid point (default: cores divided among jobs)")
+parser.add_argument("--engine", type=Engine, choices=list(Engine), default=Engine.CPSAT,
+                    help="distribution engine")
+parser.add_argument("--formulation", type=Formulation, choices=list(Formulation), default=Formulation.ELEMENT,
+                    help="CP-SAT model formulation")
+parser.add_argument("--solver-profile", type=SolverProfile, choices=list(SolverProfile), default=None,
+                    help="CP-SAT parameter profile (default: \"Solver profile\" from the config, or default)")
+parser.add_argument("--compare-profiles", action="store_true",
+                    help="solve the grid with each solver profile and compare time to first solution and final gap")
+parser.add_argument("--objective", type=Objective, choices=list(Objective), default=Objective.SUM,
+                    help="how the Teams count and the Obory objectives are combined")
+parser.add_argument("--balance-subteams", action="store_true",
+                    help="also balance the Subteam sizes within each Team (lowest priority)")
+parser.add_argument("--no-warm-start", action="store_true",
+                    help="do not hint grid points with the solutions of neighbouring points")
+parser.add_argument("--no-prune", action="store_true",
+                    help="solve every grid point, even those settled by bounds or other points")
+parser.add_argument("--previous", type=str, default=None,
+                    help="previous distributions (JSON) to redistribute incrementally for the new counts")
+parser.add_argument("--max-moves", type=int, default=10,
+                    help="maximum number of unchanged Kruhy moved by an incremental redistribution")
+parser.add_argument("--json", type=str, default=None,
+                    help="also write the distributions to this JSON file")
+parser.add_argument("--format", type=OutputFormat, choices=list(OutputFormat), nargs="+", default=[OutputFormat.XLSX],
+                    help="output formats, other than xlsx written next to OUTPUT with their own extension")
+parser.add_argument("--static-totals", action="store_true",
+                    help="write the Subteam sizes in the workbook as numbers instead of formulas, for printing only")
+parser.add_argument("--workbook-per-point", action="store_true",
+                    help="write each distribution to a workbook of its own, OUTPUT keeps the Summary (built by --jobs processes)")
+parser.add_argument("--load", type=str, default=None,
+                    help="read the distributions from this file (json, jsonl or csv) instead of computing them")
+parser.add_argument("--progress", action="store_true",
+                    help="print each improving solution found by the solver")
+parser.add_argument("--progress-log", type=str, default=None,
+                    help="append each improving solution (objective, bound, gap, time) to this JSON-lines file")
+parser.add_argument("--incumbent-dir", type=str, default=None,
+                    help="write each improving distribution to this directory as it is found")
+parser.add_argument("--gap-limit", type=float, default=None,
+                    help="stop solving a point once the relative gap between objective and bound is below this")
+parser.add_argument("--time-budget", type=float, default=None,
+                    help="total solving time in seconds for the whole grid, allocated adaptively to the points")
+parser.add_argument("--cache-dir", type=str, default=".distribute_cache",
+                    help="directory of the solution cache")
+parser.add_argument("--no-cache", action="store_true",
+                    help="neither use nor store cached solutions")
+parser.add_argument("--cache-max-age", type=float, default=30,
+                    help="days after which unused cached solutions are evicted")
+parser.add_argument("--cache-max-size", type=float, default=100,
+                    help="size of the cache in MB above which the least recently used solutions are evicted")
+parser.add_argument("--model-size", action="store_true",
+                    help="only report the model sizes of all formulations for each grid point")
+parser.add_argument("--snapshot-dir", type=str, default=None,
+                    help="write the CP-SAT model of each solved point with its Kruhy and parameters here, see replay.py")
+parser.add_argument("--snapshot-hard", action="store_true",
+                    help=f"only snapshot the points not proven optimal or solved in more than {SNAPSHOT_HARD_TIME}s")
+parser.add_argument("--watch", action="store_true",
+                    help="keep running, solve again whenever COUNTS changes and replace the outputs at once")
+parser.add_argument("--watch-interval", type=float, default=0.5,
+                    help="seconds between the checks of COUNTS in watch mode")
+parser.add_argument("--watch-debounce", type=float, default=2.0,
+                    help=f"seconds COUNTS must stay unchanged before it is solved, at most {WATCH_DEBOUNCE_LIMIT} times as long")
+instrument.add_arguments(parser)
 
 
 class Obor(StrEnum):
@@ -53,9 +196,51 @@ class Solution:
     status: Status
     distribution: T_Distribution
     time: float = None
+    error: str = None
+    num_variables: int = None
+    num_constraints: int = None
+    build_time: float = None  # seconds of the model construction, included in time
+    first_solution_time: float = None  # seconds until the first solution of the solver
+    objective: float = None
+    bound: float = None
+    note: str = None
+    interrupted: bool = False
+    time_spent: dict[str, float] = field(default_factory=dict)  # solving phase -> seconds
+
+
+@dataclass
+class SolverOptions:
+    time_limit: float = SOLVER_TIME_LIMIT
+    num_workers: int = 0  # CP-SAT search workers (threads) as given by --threads, 0 leaves them to the profile
+    jobs: int = 1  # grid points solved concurrently, dividing the cores among them
+    formulation: Formulation = Formulation.ELEMENT
+    engine: Engine = Engine.CPSAT
+    profile: SolverProfile = SolverProfile.DEFAULT
+    objective: Objective = Objective.SUM
+    balance_subteams: bool = False  # minimize the difference of Subteam sizes within each Team, lowest priority
+    warm_start: bool = True  # hint each grid point with the closest already solved one
+    prune: bool = True  # skip grid points settled by bounds or by already solved points
+    max_moves: int = 10  # unchanged Kruhy moved by an incremental redistribution
+    gap_limit: float = None  # stop once the relative gap between objective and bound is below
+    progress: bool = False  # print each improving solution
+    progress_log: str = None  # JSON-lines file of the improving solutions
+    incumbent_dir: str = None  # directory each improving distribution is written to
+    snapshot_dir: str = None  # directory the solved models are written to, see write_snapshot
+    snapshot_hard: bool = False  # snapshot only the points not proven optimal quickly
+
+    def signature(self) -> dict:
+        # - Parameters which change the computed solutions
+        return {
+            "formulation": str(self.formulation),
+            "engine": str(self.engine),
+            "objective": str(self.objective),
+            "balance_subteams": self.balance_subteams,
+        }
 
 T_Distribution = list[list[list[Kruh]]]
 
+CSV_HEADER = ["teams", "max_subteam_size", "team", "team_name", "subteam", "subteam_name", "kruh", "part", "count", "obor"]
+
 # UTILS ================================================================================================================
 
 def read_config(config_file) -> dict:
@@ -70,56 +255,1242 @@ def read_counts(counts_file) -> dict[int, int]:
     counts = {int(k): v for k, v in counts.items()}
     return counts
 
+def solution_to_dict(solution: Solution) -> dict:
+    return {
+        "num_teams": solution.num_teams,
+        "max_subteam_size": solution.max_subteam_size,
+        "status": solution.status.name,
+        "distribution": [[[[kruh.id, kruh.count, str(kruh.obor)] for kruh in subteam] for subteam in team]
+                         for team in solution.distribution],
+        "time": solution.time,
+        "objective": solution.objective,
+        "bound": solution.bound,
+    }
+
+
+def solution_from_dict(data: dict, kruhy_ids: set[int] = None) -> Solution:
+    # - With the ids of the Kruhy, the split Kruhy of older JSON files are read as well, see legacy_kruh_id;
+    #   cache entries of the older ids have another MODEL_VERSION and are never read
+    distribution = [[[Kruh(legacy_kruh_id(kruh_id, kruhy_ids), count, Obor(obor)) for kruh_id, count, obor in subteam] for subteam in team]
+                    for team in data["distribution"]]
+    return Solution(data["num_teams"], data["max_subteam_size"], Solution.Status[data["status"]], distribution,
+                    time=data.get("time"), objective=data.get("objective"), bound=data.get("bound"))
+
 # SOLVING ==============================================================================================================
 
-def compute_distributions(counts: dict[int, int], config: dict) -> list[Solution]:
-    def compute_kruhy_split(team_size: int):
-        kruhy_split = []
-        friends = []
-        for kruh in kruhy:
-            if kruh.count <= team_size:
-                kruhy_split.append(kruh)
-            else:
-                full_count, remainder = divmod(kruh.count, team_size)
-                splits = []
-                for i_full in range(full_count):
-                    splits.append(Kruh(100*kruh.id + i_full, team_size, kruh.obor))
-                if remainder > 0:
-                    splits.append(Kruh(100*kruh.id + i_full + 1, remainder, kruh.obor))
-                kruhy_split.extend(splits)
-                friends.append(splits)
+def compute_kruhy_split(kruhy: list[Kruh], team_size: int) -> tuple[list[Kruh], list[list[Kruh]]]:
+    kruhy_split = []
+    friends = []
+    for kruh in kruhy:
+        if kruh.count <= team_size:
+            kruhy_split.append(kruh)
+        else:
+            full_count, remainder = divmod(kruh.count, team_size)
+            splits = []
+            for i_full in range(full_count):
+                splits.append(Kruh(split_part_id(kruh.id, i_full), team_size, kruh.obor))
+            if remainder > 0:
+                splits.append(Kruh(split_part_id(kruh.id, i_full + 1), remainder, kruh.obor))
+            kruhy_split.extend(splits)
+            friends.append(splits)
+
+    return kruhy_split, friends
 
-        return kruhy_split, friends
 
-    kruhy = [Kruh(kruh, counts[kruh], Obor(obor["Name"]))
-             for obor in config["Obory"] for kruh in obor["Kruhy"]
-             if kruh in counts]
+def make_kruhy(counts: dict[int, int], config: dict) -> list[Kruh]:
+    return [Kruh(kruh, counts[kruh], Obor(obor["Name"]))
+            for obor in config["Obory"] for kruh in obor["Kruhy"]
+            if kruh in counts]
+
+
+def compute_distributions(counts: dict[int, int], config: dict, jobs: int = 1, options: SolverOptions = None,
+                          cache: SolutionCache = None, previous: list[Solution] = None, time_budget: float = None,
+                          known: dict[tuple[int, int], tuple[str, Solution]] = None) -> list[Solution]:
+    # - known holds the points solved by the earlier runs of the watch mode with their SolutionCache keys,
+    #   it is updated with the points solved now
+    if options is None:
+        options = SolverOptions()
+
+    kruhy = make_kruhy(counts, config)
 
     possible_nums_teams = config["Possible Teams counts"]
     possible_team_sizes = config["Possible Teams sizes"]
 
-    solutions = []
-    for properties in itertools.product(possible_nums_teams, possible_team_sizes):
-        num_teams, max_subteam_size = properties
+    points = list(itertools.product(possible_nums_teams, possible_team_sizes))
+    splits = {max_subteam_size: compute_kruhy_split(kruhy, max_subteam_size) for max_subteam_size in possible_team_sizes}
+    solutions = {}
+    previous = {(solution.num_teams, solution.max_subteam_size): solution for solution in previous or []
+                if solution.distribution}
+    redistributed = set()  # - points repaired from a previous or known distribution, neither cached nor refined
+
+    # - With pruning, each Subteam size is solved from the most Teams down, as results propagate to fewer Teams
+    order = points
+    if options.prune:
+        order = sorted(points, key=lambda point: (possible_team_sizes.index(point[1]), -point[0]))
+
+    # - With concurrent jobs, which points are solved by the time a point starts depends on their completion order;
+    #   the deterministic profile is therefore not hinted from other points to give the same results on every run
+    cross_point_hints = options.profile != SolverProfile.DETERMINISTIC or jobs <= 1
+
+    def neighbour_hint(point: tuple[int, int]) -> T_Distribution:
+        # - Best solved point closest in the grid, the distributions of neighbouring points are nearly identical
+        def grid_distance(other: tuple[int, int]) -> int:
+            return (abs(possible_nums_teams.index(point[0]) - possible_nums_teams.index(other[0]))
+                    + abs(possible_team_sizes.index(point[1]) - possible_team_sizes.index(other[1])))
+
+        solved = [(grid_distance(other), solution.objective, other) for other, solution in solutions.items()
+                  if solution.status in {Solution.Status.FEASIBLE, Solution.Status.OPTIMAL}]
+        if not options.warm_start or not solved or not cross_point_hints:
+            return None
+        _, _, best = min(solved)
+        return solutions[best].distribution
+
+    def settle(point: tuple[int, int]) -> Solution | None:
+        # - Resolves the point without solving, from the bounds or from the already solved points
+        num_teams, max_subteam_size = point
+        reason = infeasibility_reason(num_teams, config["Subteams count"], max_subteam_size, *splits[max_subteam_size])
+        if reason is not None:
+            return Solution(num_teams, max_subteam_size, Solution.Status.INFEASIBLE, [], time=0, note=f"skipped: {reason}")
+
+        for (other_num_teams, other_max_subteam_size), other in solutions.items():
+            if other_max_subteam_size != max_subteam_size or other_num_teams <= num_teams:
+                continue
+            # - Fewer Teams than an infeasible point are infeasible too
+            if other.status == Solution.Status.INFEASIBLE:
+                return Solution(num_teams, max_subteam_size, Solution.Status.INFEASIBLE, [], time=0,
+                                note=f"skipped: #Teams={other_num_teams} is infeasible")
+            # - An optimum using at most num_teams Teams is also optimal for num_teams,
+            #   unless the point is redistributed from a previous distribution
+            if other.status == Solution.Status.OPTIMAL and len(other.distribution) <= num_teams and point not in previous:
+                return Solution(num_teams, max_subteam_size, Solution.Status.OPTIMAL, other.distribution, time=0,
+                                objective=other.objective, bound=other.bound,
+                                note=f"skipped: optimum of #Teams={other_num_teams} uses {len(other.distribution)} Teams")
+        return None
+
+    def prepare(point: tuple[int, int], point_options: SolverOptions) -> tuple | Solution:
+        num_teams, max_subteam_size = point
+        if options.prune and (settled := settle(point)) is not None:
+            return settled
+
+        if known is not None and point in known:
+            known_key, known_solution = known[point]
+            # - Points whose Kruhy did not change are kept, the others are repaired locally from their last distribution
+            if known_key == SolutionCache.key(kruhy, config, *point, options):
+                return replace(known_solution, time=0, note="counts unchanged")
+            if known_solution.distribution:
+                redistributed.add(point)
+                return (num_teams, max_subteam_size, *splits[max_subteam_size], config, point_options, None, known_solution)
+
+        if point in previous:
+            redistributed.add(point)
+            return (num_teams, max_subteam_size, *splits[max_subteam_size], config, point_options, None, previous[point])
+
+        hint = neighbour_hint(point)
+        if cache is not None and (cached := cache.load(SolutionCache.key(kruhy, config, *point, options))) is not None:
+            solution, time_limit = cached
+            # - A feasible solution is only improved upon when more time is given, starting from it
+            if solution.status != Solution.Status.FEASIBLE or point_options.time_limit <= time_limit:
+                solution.note = f"cached, solved in {solution.time:.2f}s" + (f"; {solution.note}" if solution.note else "")
+                solution.time = 0
+                return solution
+            hint = solution.distribution
+
+        return (num_teams, max_subteam_size, *splits[max_subteam_size], config, point_options, hint)
+
+    def resume(point: tuple[int, int], point_options: SolverOptions) -> tuple:
+        # - Continues solving the point from its last incumbent, if any
+        num_teams, max_subteam_size = point
+        hint = solutions[point].distribution or neighbour_hint(point)
+        return (num_teams, max_subteam_size, *splits[max_subteam_size], config, point_options, hint)
+
+    def finish(point: tuple[int, int], solution: Solution, phase: str, time_limit: float):
+        solution.time_spent = {phase: solution.time} if solution.time else {}
+        if point in solutions:
+            # - A resumed point accumulates its time and keeps the better of its distributions
+            last = solutions[point]
+            solution.time_spent = last.time_spent | {phase: last.time_spent.get(phase, 0) + solution.time}
+            if last.distribution and (not solution.distribution or solution.objective > last.objective):
+                solution.status, solution.distribution = last.status, last.distribution
+                solution.objective, solution.bound = last.objective, max(last.bound, solution.bound or last.bound)
+                if solution.bound >= solution.objective:
+                    solution.status = Solution.Status.OPTIMAL
+            solution.time = sum(solution.time_spent.values())
+            time_limit = solution.time
+
+        report_solution(solution)
+        solutions[point] = solution
+        # - Only the points solved in full here are cached, with their notes; not those settled, reused or redistributed
+        if (cache is not None and solution.time and point not in redistributed and solution.error is None and not solution.interrupted
+                and solution.status != Solution.Status.UNKNOWN):
+            cache.store(SolutionCache.key(kruhy, config, *point, options), solution, time_limit)
+        if known is not None and solution.error is None and not solution.interrupted:
+            known[point] = (SolutionCache.key(kruhy, config, *point, options), solution)
+
+    def past_deadline(point: tuple[int, int], deadline: float | None) -> bool:
+        # - A point not started before the deadline keeps its last solution, or is left unsolved
+        if deadline is None or time.time() < deadline:
+            return False
+        if point not in solutions:
+            solutions[point] = Solution(*point, Solution.Status.UNKNOWN, [], time=0, note="not solved, time budget spent")
+        return True
+
+    def run(batch: list[tuple[int, int]], make_task, point_options: SolverOptions, phase: str, deadline: float = None):
+        if jobs <= 1:
+            for point in batch:
+                if cancelled():
+                    raise KeyboardInterrupt
+                task = make_task(point, point_options)
+                if isinstance(task, Solution):
+                    finish(point, task, phase, point_options.time_limit)
+                    continue
+                if past_deadline(point, deadline):
+                    continue
+                print(f"Computing solution for #Teams={point[0]}, MaxSubteamSize={point[1]}")
+                finish(point, solution := solve_point(*task), phase, point_options.time_limit)
+                if solution.interrupted:
+                    raise KeyboardInterrupt
+            return
+
+        # - Grid points are solved concurrently; a point is only submitted once a worker is free,
+        #   so that it can be warm-started from the points solved meanwhile
+        print(f"Computing {len(batch)} solutions using {jobs} jobs")
+        initializer = None if _cancel is None else functools.partial(set_cancel_event, _cancel)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=initializer) as executor:
+            queue = list(batch)
+            pending = {}
+            try:
+                while queue or pending:
+                    if cancelled():
+                        raise KeyboardInterrupt
+                    while queue and len(pending) < jobs:
+                        point = queue.pop(0)
+                        task = make_task(point, point_options)
+                        if isinstance(task, Solution):
+                            finish(point, task, phase, point_options.time_limit)
+                            continue
+                        if past_deadline(point, deadline):
+                            continue
+                        pending[executor.submit(solve_point, *task)] = point
+                    if not pending:
+                        continue
+
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        point = pending.pop(future)
+                        try:
+                            solution = future.result()
+                        except Exception as e:  # e.g. a worker process was killed
+                            solution = Solution(*point, Solution.Status.UNKNOWN, [], time=0, error=repr(e))
+                        finish(point, solution, phase, point_options.time_limit)
+                        if solution.interrupted:
+                            raise KeyboardInterrupt
+            except KeyboardInterrupt:
+                # - The workers received the Ctrl+C too, their solvers return the best solutions found
+                executor.shutdown(wait=True, cancel_futures=True)
+                for future, point in pending.items():
+                    if not future.cancelled() and future.exception() is None:
+                        finish(point, future.result(), phase, point_options.time_limit)
+                raise
+
+    def interrupt():
+        # - Ctrl+C stops the sweep, the points solved so far (and the best incumbents) are kept
+        if cancelled():
+            print("Cancelled, newer counts arrived")
+        else:
+            print("Interrupted, keeping the distributions computed so far")
+        for point in points:
+            if point not in solutions:
+                solutions[point] = Solution(*point, Solution.Status.UNKNOWN, [], time=0, note="not solved, interrupted")
+
+    def refinable() -> list[tuple[int, int]]:
+        # - Points without any solution yet, then points with an open gap and an objective close to the best one
+        solved = [point for point in order if solutions[point].time and solutions[point].error is None
+                  and point not in redistributed]
+        unknown = [point for point in solved if solutions[point].status == Solution.Status.UNKNOWN]
+        feasible = [point for point in solved if solutions[point].status == Solution.Status.FEASIBLE
+                    and solutions[point].bound is not None]
+        if feasible:
+            best_objective = min(solutions[point].objective for point in feasible)
+            feasible = [point for point in feasible
+                        if solutions[point].objective <= best_objective * (1 + SCHEDULE_COMPETITIVE_MARGIN)
+                        and solutions[point].bound < solutions[point].objective * (1 - (options.gap_limit or 0))]
+        return unknown + sorted(feasible, key=lambda point: (solutions[point].objective, solutions[point].bound))
 
-        kruhy_split, kruhy_friends = compute_kruhy_split(max_subteam_size)
-        print(f"Computing solution for #Teams={num_teams}, MaxSubteamSize={max_subteam_size}")
+    try:
+        if time_budget is None:
+            run(order, prepare, options, "solve")
+        else:
+            # - Short probing runs of all the points first, the rest of the budget is then given in rounds
+            #   to the points still worth improving. The probes take SCHEDULE_PROBE_SHARE of the budget,
+            #   in as many rounds as the points need with the jobs; the points not started by the deadline are left out
+            t_deadline = time.time() + time_budget
+            rounds = math.ceil(len(points) / jobs)
+            probe_limit = min(options.time_limit, SCHEDULE_PROBE_SHARE * time_budget / rounds)
+            run(order, prepare, replace(options, time_limit=probe_limit), "probe", t_deadline)
+
+            while (time_left := t_deadline - time.time()) > SCHEDULE_MIN_SLICE:
+                candidates = refinable()
+                if not candidates:
+                    break
+                # - The time left in whole rounds of the jobs, the slices no shorter than SCHEDULE_MIN_SLICE
+                rounds = min(math.ceil(len(candidates) / jobs), max(1, int(time_left / SCHEDULE_MIN_SLICE)))
+                time_slice = time_left / rounds
+                candidates = candidates[:rounds * jobs]
+                run(candidates, resume, replace(options, time_limit=time_slice), "refine", t_deadline)
+
+            report_schedule([solutions[point] for point in points], time_budget)
+    except KeyboardInterrupt:
+        interrupt()
+
+
+    if cache is not None:
+        cache.evict()
+
+    return [solutions[point] for point in points]
+
+
+def bins_lower_bound(sizes: list[int], capacity: int) -> int:
+    # - Martello-Toth L2 lower bound on the number of bins of given capacity needed to pack the items
+    best = 0
+    for k in {0} | {size for size in sizes if size <= capacity // 2}:
+        large = [size for size in sizes if size > capacity - k]
+        medium = [size for size in sizes if capacity - k >= size > capacity / 2]
+        small = [size for size in sizes if capacity / 2 >= size >= k]
+        medium_free = len(medium) * capacity - sum(medium)
+        small_bins = max(0, -((medium_free - sum(small)) // capacity))
+        best = max(best, len(large) + len(medium) + small_bins)
+    return best
+
+
+def infeasibility_reason(num_teams: int, num_subteams: int, max_subteam_size: int, kruhy: list[Kruh], kruhy_friends: list[list[Kruh]]) -> str | None:
+    team_capacity = num_subteams * max_subteam_size
+    total = sum(kruh.count for kruh in kruhy)
+    if total > num_teams * team_capacity:
+        return f"capacity {num_teams}*{num_subteams}*{max_subteam_size} < {total} people"
+
+    # - Friends must be in a same Team, so they are a single item when packing Teams
+    split_ids = {friend.id for friends in kruhy_friends for friend in friends}
+    team_items = ([sum(friend.count for friend in friends) for friends in kruhy_friends]
+                  + [kruh.count for kruh in kruhy if kruh.id not in split_ids])
+    if max(team_items, default=0) > team_capacity:
+        return f"a split Kruh of {max(team_items)} people does not fit into a Team of {team_capacity}"
+
+    subteams_needed = bins_lower_bound([kruh.count for kruh in kruhy], max_subteam_size)
+    if subteams_needed > num_teams * num_subteams:
+        return f"at least {subteams_needed} Subteams needed, only {num_teams * num_subteams} available"
+
+    teams_needed = bins_lower_bound(team_items, team_capacity)
+    if teams_needed > num_teams:
+        return f"at least {teams_needed} Teams needed"
+
+    return None
+
+
+def report_schedule(solutions: list[Solution], time_budget: float):
+    print(f"Time budget {time_budget:.0f}s spent:")
+    for solution in solutions:
+        if solution.time_spent:
+            phases = ", ".join(f"{phase} {spent:.2f}s" for phase, spent in solution.time_spent.items())
+            print(f"> [#Teams={solution.num_teams}, MaxSubteamSize={solution.max_subteam_size}] {phases}. Result: {solution.status.name}")
+    print(f"> total {sum(sum(solution.time_spent.values()) for solution in solutions):.2f}s of solver time")
 
-        t_start = time.time()
-        solution = compute_teams_distribution(num_teams, max_subteam_size, kruhy_split, kruhy_friends, config)
-        t_end = time.time()
-        solution.time = t_end - t_start
 
-        print(f"> Computed in {solution.time:.2f}s. Result: {solution.status.name}")
-        solutions.append(solution)
+def solve_point(num_teams: int, max_subteam_size: int, kruhy: list[Kruh], kruhy_friends: list[list[Kruh]], config: dict, options: SolverOptions,
+                hint: T_Distribution = None, previous: Solution = None) -> Solution:
+    t_start = time.time()
+    try:
+        with instrument.span(f"solve point ({options.engine})"):
+            if previous is not None:
+                solution = compute_teams_redistribution(num_teams, max_subteam_size, kruhy, kruhy_friends, config, options, previous)
+            else:
+                solution = ENGINES[options.engine](num_teams, max_subteam_size, kruhy, kruhy_friends, config, options, hint)
+    except Exception as e:
+        solution = Solution(num_teams, max_subteam_size, Solution.Status.UNKNOWN, [], error=repr(e))
+    t_end = time.time()
+    solution.time = t_end - t_start
+    return solution
 
-    return solutions
+
+def split_part_id(kruh_id: int, part: int) -> int:
+    # - Split Kruhy have negative ids -(100*id + part), distinct from the ids of any Kruhy
+    return -(100*kruh_id + part)
+
+
+def split_kruh_id(kruh_id: int) -> tuple[int, int]:
+    # - See split_part_id
+    if kruh_id >= 0:
+        return kruh_id, 0
+    return divmod(-kruh_id, 100)
 
 
-def compute_teams_distribution(num_teams: int, max_subteam_size: int, kruhy: list[Kruh], kruhy_friends: list[list[Kruh]], config: dict) -> Solution:
+def legacy_kruh_id(kruh_id: int, kruhy_ids: set[int] | None) -> int:
+    # - Split Kruhy used to have ids 100*id + part, which also are the ids of Kruhy from 100 on;
+    #   an id of 100 or more which is not of any Kruh is such an old split id (unknown without kruhy_ids)
+    if kruhy_ids is not None and kruh_id >= 100 and kruh_id not in kruhy_ids:
+        return split_part_id(*divmod(kruh_id, 100))
+    return kruh_id
+
+
+def config_kruhy_ids(config: dict) -> set[int]:
+    return {kruh for obor in config["Obory"] for kruh in obor["Kruhy"]}
+
+
+def remap_distribution(distribution: T_Distribution, kruhy: list[Kruh], kruhy_friends: list[list[Kruh]], num_teams: int, num_subteams: int,
+                       max_subteam_size: int, formulation: Formulation) -> dict[int, tuple[int, int]]:
+    # - Places the (possibly differently split) Kruhy where their parts are in the distribution,
+    #   then repacks the placement so that the model admits it, see repack_placement
+    parts_placement = defaultdict(dict)
+    for i_team, team in enumerate(distribution):
+        for i_subteam, subteam in enumerate(team):
+            for kruh in subteam:
+                kruh_id, kruh_part = split_kruh_id(kruh.id)
+                parts_placement[kruh_id][kruh_part] = (i_team, i_subteam)
+
+    placement = {}
+    for kruh in kruhy:
+        kruh_id, kruh_part = split_kruh_id(kruh.id)
+        if kruh_id not in parts_placement:
+            continue
+        parts = parts_placement[kruh_id]
+        team, subteam = parts.get(kruh_part, parts[max(parts)])
+        if team < num_teams and subteam < num_subteams:
+            placement[kruh.id] = (team, subteam)
+    return repack_placement(placement, kruhy, kruhy_friends, num_subteams, max_subteam_size, formulation)
+
+
+def repack_placement(placement: dict[int, tuple[int, int]], kruhy: list[Kruh], kruhy_friends: list[list[Kruh]], num_subteams: int,
+                     max_subteam_size: int, formulation: Formulation) -> dict[int, tuple[int, int]]:
+    # - A remapped placement is not always a solution: the parts of a newly split Kruh share the Subteam of the old one,
+    #   friends may be apart, and the symmetry breaking fixes the order of Teams and Subteams.
+    #   The Kruhy of each Team are repacked within capacity and the Teams renumbered in the order of the formulation,
+    #   a Team which cannot be packed (or friends apart) is left out for the solver to place.
+    friends_of = {kruh.id: friends for friends in kruhy_friends for kruh in friends}
+    teams = defaultdict(list)
+    for kruh in kruhy:
+        if kruh.id not in placement:
+            continue
+        team = placement[kruh.id][0]
+        if all(placement.get(friend.id, (None,))[0] == team for friend in friends_of.get(kruh.id, [])):
+            teams[team].append(kruh)
+
+    packed = []
+    for team, members in sorted(teams.items()):
+        subteams = repack_team(members, {kruh.id: placement[kruh.id][1] for kruh in members}, num_subteams, max_subteam_size,
+                               contiguous=formulation == Formulation.ELEMENT)
+        if subteams is not None:
+            packed.append(subteams)
+
+    if formulation == Formulation.COMPACT:
+        # - Teams and Subteams ordered by non-increasing size
+        for subteams in packed:
+            subteams.sort(key=lambda members: sum(kruh.count for kruh in members), reverse=True)
+        packed.sort(key=lambda subteams: sum(kruh.count for members in subteams for kruh in members), reverse=True)
+    # - Teams used consecutively in both formulations
+    return {kruh.id: (team, subteam)
+            for team, subteams in enumerate(packed) for subteam, members in enumerate(subteams) for kruh in members}
+
+
+def repack_team(members: list[Kruh], subteam_of: dict[int, int], num_subteams: int, max_subteam_size: int,
+                contiguous: bool) -> list[list[Kruh]] | None:
+    # - Packs the Kruhy of a Team into its Subteams, keeping each in its Subteam while it fits.
+    #   With contiguous (the element formulation) the Subteams must not decrease in the order of the Kruhy,
+    #   a placement which does not is packed anew next-fit in that order.
+    subteams = [[] for _ in range(num_subteams)]
+    loads = [0] * num_subteams
+    if contiguous:
+        kept = [subteam_of[kruh.id] for kruh in members]
+        if kept == sorted(kept):
+            for kruh, subteam in zip(members, kept):
+                subteams[subteam].append(kruh)
+                loads[subteam] += kruh.count
+            if max(loads) <= max_subteam_size:
+                return subteams
+            subteams, loads = [[] for _ in range(num_subteams)], [0] * num_subteams
+        subteam = 0
+        for kruh in members:
+            if loads[subteam] + kruh.count > max_subteam_size:
+                subteam += 1
+                if subteam == num_subteams or kruh.count > max_subteam_size:
+                    return None
+            subteams[subteam].append(kruh)
+            loads[subteam] += kruh.count
+        return subteams
+
+    for kruh in sorted(members, key=lambda kruh: kruh.count, reverse=True):
+        fitting = [subteam for subteam in [subteam_of[kruh.id], *range(num_subteams)] if loads[subteam] + kruh.count <= max_subteam_size]
+        if not fitting:
+            return None
+        subteams[fitting[0]].append(kruh)
+        loads[fitting[0]] += kruh.count
+    return subteams
+
+
+def report_solution(solution: Solution):
+    point = f"[#Teams={solution.num_teams}, MaxSubteamSize={solution.max_subteam_size}]"
+    if solution.error is not None:
+        print(f"> {point} Failed after {solution.time:.2f}s: {solution.error}")
+    elif solution.time == 0:  # - resolved without solving
+        print(f"> {point} Result: {solution.status.name}, {solution.note}")
+    else:
+        objective = ""
+        if solution.objective is not None:
+            objective = f" (objective {solution.objective:g}" + (f", bound {solution.bound:g})" if solution.bound is not None else ")")
+        model_size = ""
+        if solution.num_variables is not None:
+            model_size = f" Model: {solution.num_variables} variables, {solution.num_constraints} constraints"
+        if solution.build_time is not None:
+            model_size += f", built in {solution.build_time:.2f}s"
+        print(f"> {point} Computed in {solution.time:.2f}s. Result: {solution.status.name}{objective}.{model_size}")
+        if solution.note is not None:
+            print(f"  {solution.note}")
+
+
+def report_model_sizes(counts: dict[int, int], config: dict):
+    kruhy = make_kruhy(counts, config)
+    num_subteams = config["Subteams count"]
+
+    splits = {max_subteam_size: compute_kruhy_split(kruhy, max_subteam_size) for max_subteam_size in config["Possible Teams sizes"]}
+    for num_teams, max_subteam_size in itertools.product(config["Possible Teams counts"], config["Possible Teams sizes"]):
+        kruhy_split, kruhy_friends = splits[max_subteam_size]
+        print(f"#Teams={num_teams}, MaxSubteamSize={max_subteam_size}, #Kruhy={len(kruhy_split)}")
+        for formulation, build_model in MODEL_BUILDERS.items():
+            t_start = time.time()
+            dmodel = build_model(num_teams, num_subteams, max_subteam_size, kruhy_split, kruhy_friends)
+            t_end = time.time()
+            num_variables, num_constraints = dmodel.size()
+            print(f"> {formulation:<8} {num_variables:>8} variables {num_constraints:>8} constraints  built in {t_end - t_start:.2f}s")
+
+
+def available_workers(options: SolverOptions) -> int:
+    # - Explicit --threads, or the cores of the machine divided among the concurrent jobs
+    return options.num_workers or max(1, (os.cpu_count() or 1) // options.jobs)
+
+
+def make_solver(options: SolverOptions, time_limit: float = None) -> cp_model.CpSolver:
+    solver = cp_model.CpSolver()
+    for name, value in SOLVER_PROFILES[options.profile].items():
+        setattr(solver.parameters, name, value)
+    time_limit = options.time_limit if time_limit is None else time_limit
+    if options.profile == SolverProfile.DETERMINISTIC:
+        # - The wall time limit would make the result depend on the machine load, it only guards against slow machines
+        solver.parameters.max_deterministic_time = time_limit
+        time_limit *= 10
+    solver.parameters.max_time_in_seconds = time_limit
+    if options.num_workers > 0:
+        solver.parameters.num_workers = options.num_workers
+    elif options.jobs > 1 or options.profile in PROFILE_MAX_WORKERS:
+        cores = available_workers(options)
+        solver.parameters.num_workers = min(cores, PROFILE_MAX_WORKERS.get(options.profile, cores))
+    if options.gap_limit is not None:
+        solver.parameters.relative_gap_limit = options.gap_limit
+    return solver
+
+
+_cancel: multiprocessing.Event = None  # set by the watch mode when newer counts arrive, shared with the workers
+
+
+def set_cancel_event(event: multiprocessing.Event):
+    global _cancel
+    _cancel = event
+
+
+def cancelled() -> bool:
+    return _cancel is not None and _cancel.is_set()
+
+
+def solve_interruptible(solver: cp_model.CpSolver, model: cp_model.CpModel,
+                        callback: cp_model.CpSolverSolutionCallback = None) -> tuple[int, bool]:
+    # - Solved in a thread, so that Ctrl+C reaches the main thread, which stops the search and knows it was interrupted;
+    #   outside of the main thread the solver handles Ctrl+C itself. A cancelled solve stops as if interrupted.
+    #   Interruption is known only from Ctrl+C or the cancellation, never guessed from the status and the time taken:
+    #   a search stopped by --gap-limit also ends FEASIBLE before its time limit.
+    if threading.current_thread() is not threading.main_thread():
+        return solver.solve(model, callback), False
+
+    solver.parameters.catch_sigint_signal = False
+    result = {}
+    done = threading.Event()
+
+    def solve():
+        try:
+            result["status"] = solver.solve(model, callback)
+        except Exception as e:
+            result["error"] = e
+        done.set()
+
+    threading.Thread(target=solve, daemon=True).start()
+    interrupted = False
+    while not done.is_set():
+        try:
+            done.wait(0.1)
+        except KeyboardInterrupt:
+            interrupted = True
+            solver.stop_search()
+        if cancelled() and not interrupted:
+            interrupted = True
+            solver.stop_search()
+    if "error" in result:
+        raise result["error"]
+    return result["status"], interrupted
+
+
+@functools.cache
+def progress_callback_class() -> type:
+    # - Defined on the first use, deriving from CP-SAT would import it
+    class ProgressCallback(cp_model.CpSolverSolutionCallback):
+        def __init__(self, dmodel: DistributionModel, num_teams: int, max_subteam_size: int, options: SolverOptions):
+            super().__init__()
+            self.dmodel = dmodel
+            self.num_teams = num_teams
+            self.max_subteam_size = max_subteam_size
+            self.options = options
+            self.num_solutions = 0
+            self.best = None
+            self.t_start = time.time()
+            self.first_solution_time = None
+
+        def on_solution_callback(self):
+            self.num_solutions += 1
+            objective, bound, elapsed = self.objective_value, self.best_objective_bound, self.wall_time
+            gap = abs(objective - bound) / max(1.0, abs(objective))
+            point = (self.num_teams, self.max_subteam_size)
+            if self.first_solution_time is None:
+                self.first_solution_time = time.time() - self.t_start
+
+            if self.options.progress:
+                print(f"  [#Teams={point[0]}, MaxSubteamSize={point[1]}] #{self.num_solutions} "
+                      f"objective {objective:g}, bound {bound:g}, gap {100 * gap:.1f}% at {elapsed:.2f}s")
+
+            if self.options.progress_log is not None:
+                record = {
+                    "num_teams": point[0],
+                    "max_subteam_size": point[1],
+                    "solution": self.num_solutions,
+                    "objective": objective,
+                    "bound": bound,
+                    "gap": gap,
+                    "time": elapsed,
+                }
+                with open(self.options.progress_log, "a", encoding="utf8") as file:
+                    file.write(json.dumps(record) + "\n")
+
+            self.best = Solution(*point, Solution.Status.FEASIBLE, self.dmodel.extract_distribution(self),
+                                 time=elapsed, objective=objective, bound=bound)
+            if self.options.incumbent_dir is not None:
+                # - Written aside and renamed, so that the file always holds a complete distribution
+                os.makedirs(self.options.incumbent_dir, exist_ok=True)
+                path = os.path.join(self.options.incumbent_dir, f"incumbent-{point[0]}_{point[1]}.json")
+                with open(f"{path}.tmp", "w", encoding="utf8") as file:
+                    json.dump(solution_to_dict(self.best), file, ensure_ascii=False)
+                os.replace(f"{path}.tmp", path)
+
+    return ProgressCallback
+
+
+def compute_teams_distribution(num_teams: int, max_subteam_size: int, kruhy: list[Kruh], kruhy_friends: list[list[Kruh]], config: dict, options: SolverOptions = None,
+                               hint: T_Distribution = None) -> Solution:
+    if options is None:
+        options = SolverOptions()
+
     num_subteams = config["Subteams count"]
 
     # Build model ------------------------------------------------------------------------------------------------------
+
+    t_build = time.time()
+    max_num_teams = max(num_teams, *config["Possible Teams counts"])
+    with instrument.span("build model"):
+        dmodel = build_model_parametric(num_teams, num_subteams, max_subteam_size, kruhy, kruhy_friends, options.formulation, max_num_teams)
+    model = dmodel.model
+    build_time = time.time() - t_build
+    stages = objective_stages(dmodel, max_subteam_size, options)
+
+    if options.engine == Engine.HYBRID:
+        heuristic = compute_teams_distribution_heuristic(num_teams, max_subteam_size, kruhy, kruhy_friends, config, options, hint)
+        if heuristic.status in {Solution.Status.OPTIMAL, Solution.Status.INFEASIBLE}:
+            return heuristic
+        if heuristic.distribution:
+            # - The heuristic starts from the hint, its distribution is the better hint
+            hint = heuristic.distribution
+            # - An upper bound is only valid when the symmetry breaking admits every distribution
+            if options.formulation == Formulation.COMPACT:
+                model.add(dmodel.expression_used_team_count + dmodel.expression_team_obory_sum <= int(heuristic.objective))
+
+    if hint is not None:
+        dmodel.add_hint(remap_distribution(hint, kruhy, kruhy_friends, num_teams, num_subteams, max_subteam_size, options.formulation))
+
+    # Solve ------------------------------------------------------------------------------------------------------------
+
+    # - Each stage gets an equal share of the time left, a stage proven early leaves its time to the next ones;
+    #   the time limit of the point also covers building its model. The deterministic profile shares
+    #   its deterministic time instead, so that the stages do not depend on the machine load
+    callback = progress_callback_class()(dmodel, num_teams, max_subteam_size, options)
+    solver, status, bounds = None, cp_model.UNKNOWN, []
+    snapshot, first_stage, first_optimal = None, None, False
+    t_start = t_build
+    deterministic_spent = 0.0
+
+    def time_left() -> float:
+        if options.profile == SolverProfile.DETERMINISTIC:
+            return options.time_limit - deterministic_spent
+        return options.time_limit - (time.time() - t_start)
+
+    def solve_stage(time_limit: float) -> tuple[cp_model.CpSolver, int, bool]:
+        nonlocal deterministic_spent
+        stage_solver = make_solver(options, max(0.0, time_limit))
+        with instrument.span("solve"):
+            stage_status, interrupted = solve_interruptible(stage_solver, model, callback)
+            instrument.count("solutions", callback.num_solutions)
+        deterministic_spent += stage_solver.response_proto.deterministic_time
+        return stage_solver, stage_status, interrupted
+
+    for i_stage, objective in enumerate(stages):
+        model.minimize(objective)
+        if i_stage == 0 and options.snapshot_dir is not None:
+            # - The model exactly as given to the first solve, with its hint
+            snapshot = model.clone()
+        stage_solver, stage_status, interrupted = solve_stage(time_left() / (len(stages) - i_stage))
+        if (stage_status == cp_model.UNKNOWN and solver is None and not interrupted
+                and options.profile != SolverProfile.DETERMINISTIC and time_left() > SCHEDULE_MIN_SLICE):
+            # - Without any solution yet, the first stage is given all the time left; not with the deterministic
+            #   profile, whose result would then depend on how fast the first share ran out
+            stage_solver, stage_status, interrupted = solve_stage(time_left())
+        if i_stage == 0:
+            first_stage = (stage_solver, stage_status)
+        if stage_status not in {cp_model.OPTIMAL, cp_model.FEASIBLE}:
+            # - A later stage without a solution keeps the solution of the previous one
+            if solver is None:
+                status = stage_status
+            elif status == cp_model.OPTIMAL:
+                status = cp_model.FEASIBLE
+            break
+
+        # - With a gap limit the solver reports OPTIMAL once the gap is small enough
+        value, bound = stage_solver.objective_value, stage_solver.best_objective_bound
+        if stage_status == cp_model.OPTIMAL and bound < value:
+            stage_status = cp_model.FEASIBLE
+        solver, bounds = stage_solver, bounds + [bound]
+        status = stage_status if status != cp_model.FEASIBLE else cp_model.FEASIBLE
+        if i_stage == 0:
+            first_optimal = stage_status == cp_model.OPTIMAL
+        if interrupted or i_stage == len(stages) - 1:
+            break
+
+        # - The next stage may not worsen this one and starts from its solution
+        if stage_status == cp_model.OPTIMAL:
+            model.add(objective == int(value))
+        else:
+            model.add(objective <= int(value))
+        model.clear_hints()
+        for index, var_value in enumerate(stage_solver.response_proto.solution):
+            model.add_hint(model.get_int_var_from_proto_index(index), var_value)
+
+    # Solution ---------------------------------------------------------------------------------------------------------
+
+    distribution = []
+    if solver is not None:
+        distribution = dmodel.extract_distribution(solver)
+
+    solution = Solution(num_teams, max_subteam_size, Solution.Status(status), distribution)
+    if distribution:
+        # - The objective is always reported as the Teams count plus the Obory, comparable among the modes
+        solution.objective = solver.value(dmodel.expression_used_team_count + dmodel.expression_team_obory_sum)
+        if status == cp_model.OPTIMAL:
+            solution.bound = solution.objective
+        elif options.objective == Objective.LEXICOGRAPHIC:
+            # - The Obory bound only holds for the Teams count fixed at its optimum, without it only the Teams bound
+            #   is known; used Teams hold at least one Obor each
+            solution.bound = bounds[0] + bounds[1] if first_optimal and len(bounds) > 1 else 2 * bounds[0]
+        else:
+            solution.bound = bounds[0] // objective_weight(num_teams, max_subteam_size, options)
+    solution.num_variables, solution.num_constraints = dmodel.size()
+    solution.build_time = build_time
+    solution.first_solution_time = callback.first_solution_time
+    solution.interrupted = interrupted
+
+    if snapshot is not None and not interrupted:
+        with instrument.span("snapshot"):
+            write_snapshot(snapshot, *first_stage, solution, time.time() - t_build, kruhy, kruhy_friends, hint,
+                           num_subteams, max_num_teams, options)
+    return solution
+
+
+def objective_weight(num_teams: int, max_subteam_size: int, options: SolverOptions) -> int:
+    # - Weight of the Teams and Obory objective above the Subteams balance, exceeding any balance
+    if not options.balance_subteams:
+        return 1
+    return num_teams * max_subteam_size + 1
+
+
+def objective_stages(dmodel: DistributionModel, max_subteam_size: int, options: SolverOptions) -> list[cp_model.LinearExpr]:
+    # - Objectives in decreasing priority, either solved one after another or weighted into a single one
+    stages = [dmodel.expression_used_team_count, dmodel.expression_team_obory_sum]
+    if options.balance_subteams:
+        stages.append(dmodel.expression_subteam_balance(max_subteam_size))
+    if options.objective == Objective.LEXICOGRAPHIC:
+        return stages
+
+    objective = (stages[0] + stages[1]) * objective_weight(dmodel.num_teams, max_subteam_size, options)
+    if options.balance_subteams:
+        objective += stages[2]
+    return [objective]
+
+
+def compute_teams_redistribution(num_teams: int, max_subteam_size: int, kruhy: list[Kruh], kruhy_friends: list[list[Kruh]], config: dict, options: SolverOptions,
+                                 previous: Solution) -> Solution:
+    num_subteams = config["Subteams count"]
+    t_start = time.time()
+
+    # Diff ---------------------------------------------------------------------------------------------------------------
+
+    # - Placements outside of the Teams and Subteams of the point (e.g. a changed Subteams count) are not kept,
+    #   their Kruhy are placed anew
+    previous_parts = {}
+    previous_counts = defaultdict(int)
+    for i_team, team in enumerate(previous.distribution):
+        for i_subteam, subteam in enumerate(team):
+            for kruh in subteam:
+                kruh_id, kruh_part = split_kruh_id(kruh.id)
+                if i_team < num_teams and i_subteam < num_subteams:
+                    previous_parts[kruh_id, kruh_part] = (i_team, i_subteam)
+                previous_counts[kruh_id] += kruh.count
+
+    current_counts = defaultdict(int)
+    for kruh in kruhy:
+        current_counts[split_kruh_id(kruh.id)[0]] += kruh.count
+    changed = {kruh_id for kruh_id in previous_counts.keys() | current_counts.keys()
+               if previous_counts[kruh_id] != current_counts[kruh_id]}
+
+    # - The neighbourhood are the Teams which held a changed Kruh, their Kruhy may move anywhere
+    neighbourhood = {team for (kruh_id, _), (team, _) in previous_parts.items() if kruh_id in changed}
+    all_placements = list(itertools.product(range(num_teams), range(num_subteams)))
+    allowed = {}
+    movable = {}
+    for kruh in kruhy:
+        kruh_id, kruh_part = split_kruh_id(kruh.id)
+        placement = previous_parts.get((kruh_id, kruh_part))
+        if kruh_id in changed or placement is None:
+            allowed[kruh.id] = all_placements
+        elif placement[0] in neighbourhood:
+            allowed[kruh.id] = all_placements
+            movable[kruh.id] = placement
+        else:
+            allowed[kruh.id] = [placement]
+
+    # Local repair -------------------------------------------------------------------------------------------------------
+
+    dmodel = build_model_compact(num_teams, num_subteams, max_subteam_size, kruhy, kruhy_friends, allowed)
+    model = dmodel.model
+    # - Unchanged Kruhy of the neighbourhood stay put unless moving them improves the objective, at most max_moves move
+    expression_moved = cp_model.LinearExpr.sum([1 - dmodel.assignment[kruh_id, team, subteam]
+                                                for kruh_id, (team, subteam) in movable.items()])
+    model.add(expression_moved <= options.max_moves)
+    model.minimize(
+        (dmodel.expression_used_team_count + dmodel.expression_team_obory_sum) * (len(kruhy) + 1)
+        + expression_moved
+    )
+    dmodel.add_hint({kruh_id: placement for kruh_id, placement in movable.items()})
+
+    solver = make_solver(options)
+    callback = progress_callback_class()(dmodel, num_teams, max_subteam_size, options)
+    with instrument.span("solve"):
+        status, interrupted = solve_interruptible(solver, model, callback)
+
+    if interrupted and status not in {cp_model.OPTIMAL, cp_model.FEASIBLE}:
+        return Solution(num_teams, max_subteam_size, Solution.Status.UNKNOWN, [], interrupted=True,
+                        note=f"incremental: {len(changed)} Kruhy changed, interrupted")
+    if status == cp_model.OPTIMAL or status == cp_model.FEASIBLE:
+        distribution = dmodel.extract_distribution(solver)
+        solution = Solution(num_teams, max_subteam_size, Solution.Status.FEASIBLE, distribution)
+        solution.objective = sum(1 + len({kruh.obor for subteam in team for kruh in subteam}) for team in distribution)
+        solution.num_variables, solution.num_constraints = dmodel.size()
+        moved = sum(1 for kruh_id, (team, subteam) in movable.items()
+                    if not solver.boolean_value(dmodel.assignment[kruh_id, team, subteam]))
+        solution.note = f"incremental: {len(changed)} Kruhy changed, {moved} moved"
+        solution.interrupted = interrupted
+        return solution
+
+    if status != cp_model.INFEASIBLE:
+        # - The local repair ran out of time, no time is left for a full solve
+        return Solution(num_teams, max_subteam_size, Solution.Status.UNKNOWN, [],
+                        note=f"incremental: {len(changed)} Kruhy changed, local repair {Solution.Status(status).name.lower()}")
+
+    # - Local repair is impossible, full solve starting from the previous distribution in the time left
+    time_left = options.time_limit - (time.time() - t_start)
+    solution = compute_teams_distribution(num_teams, max_subteam_size, kruhy, kruhy_friends, config, replace(options, time_limit=time_left),
+                                          previous.distribution)
+    solution.note = f"incremental: {len(changed)} Kruhy changed, local repair infeasible, solved in full"
+    return solution
+
+
+def pack_subteams(kruhy: list[Kruh], num_subteams: int, max_subteam_size: int) -> list[list[Kruh]] | None:
+    # - Best-fit decreasing, the Kruh goes to the fullest Subteam it fits in
+    subteams = [[] for _ in range(num_subteams)]
+    loads = [0] * num_subteams
+    for kruh in sorted(kruhy, key=lambda k: -k.count):
+        fitting = [i_subteam for i_subteam in range(num_subteams) if loads[i_subteam] + kruh.count <= max_subteam_size]
+        if not fitting:
+            return None
+        i_subteam = max(fitting, key=lambda i: loads[i])
+        subteams[i_subteam].append(kruh)
+        loads[i_subteam] += kruh.count
+    return subteams
+
+
+def compute_teams_distribution_heuristic(num_teams: int, max_subteam_size: int, kruhy: list[Kruh], kruhy_friends: list[list[Kruh]], config: dict, options: SolverOptions = None,
+                                         hint: T_Distribution = None) -> Solution:
+    num_subteams = config["Subteams count"]
+
+    # - Friends are kept together as a single unit
+    split_ids = {friend.id for friends in kruhy_friends for friend in friends}
+    units = [list(friends) for friends in kruhy_friends] + [[kruh] for kruh in kruhy if kruh.id not in split_ids]
+    obor_totals = defaultdict(int)
+    for kruh in kruhy:
+        obor_totals[kruh.obor] += kruh.count
+
+    def unit_count(unit: list[Kruh]) -> int:
+        return sum(kruh.count for kruh in unit)
+
+    def team_cost(team: list[list[Kruh]]) -> int:
+        return 1 + len({unit[0].obor for unit in team}) if team else 0
+
+    def fits(team: list[list[Kruh]]) -> bool:
+        return pack_subteams([kruh for unit in team for kruh in unit], num_subteams, max_subteam_size) is not None
+
+    # Construction -----------------------------------------------------------------------------------------------------
+    # - Obor-aware first-fit decreasing: largest Obory first, each Kruh into a Team already having its Obor if possible
+
+    units.sort(key=lambda unit: (-obor_totals[unit[0].obor], str(unit[0].obor), -unit_count(unit)))
+    teams = []
+    if hint is not None:
+        # - The hinted Teams which still fit are the initial packing, the Kruhy they miss are added to them
+        placement = remap_distribution(hint, kruhy, kruhy_friends, num_teams, num_subteams, max_subteam_size, Formulation.COMPACT)
+        hinted_teams = defaultdict(list)
+        for unit in units:
+            if unit[0].id in placement:
+                hinted_teams[placement[unit[0].id][0]].append(unit)
+        teams = [team for _, team in sorted(hinted_teams.items()) if fits(team)]
+    placed = {id(unit) for team in teams for unit in team}
+    for unit in units:
+        if id(unit) in placed:
+            continue
+        obor = unit[0].obor
+        candidates = sorted(teams, key=lambda team: (obor not in {u[0].obor for u in team}, -sum(map(unit_count, team))))
+        for team in candidates:
+            if fits(team + [unit]):
+                team.append(unit)
+                break
+        else:
+            if not fits([unit]):
+                return Solution(num_teams, max_subteam_size, Solution.Status.INFEASIBLE, [],
+                                note=f"heuristic: friends of {unit_count(unit)} people fit in no Team")
+            if len(teams) == num_teams:
+                return Solution(num_teams, max_subteam_size, Solution.Status.UNKNOWN, [], note="heuristic: no fit found")
+            teams.append([unit])
+
+    # Local search -----------------------------------------------------------------------------------------------------
+    # - Relocations and swaps of units between Teams, first improvement until a local optimum
+
+    improved = True
+    while improved:
+        improved = False
+        for team_a, team_b in itertools.permutations(teams, 2):
+            for unit in list(team_a):
+                rest_a = [u for u in team_a if u is not unit]
+                delta = team_cost(rest_a) + team_cost(team_b + [unit]) - team_cost(team_a) - team_cost(team_b)
+                if delta < 0 and fits(team_b + [unit]):
+                    team_a.remove(unit)
+                    team_b.append(unit)
+                    improved = True
+                    break
+                for other in list(team_b):
+                    if other[0].obor == unit[0].obor:
+                        continue
+                    rest_b = [u for u in team_b if u is not other]
+                    delta = (team_cost(rest_a + [other]) + team_cost(rest_b + [unit])
+                             - team_cost(team_a) - team_cost(team_b))
+                    if delta < 0 and fits(rest_a + [other]) and fits(rest_b + [unit]):
+                        team_a.remove(unit)
+                        team_a.append(other)
+                        team_b.remove(other)
+                        team_b.append(unit)
+                        improved = True
+                        break
+                if improved:
+                    break
+            if improved:
+                teams = [team for team in teams if team]
+                break
+
+    # Solution ---------------------------------------------------------------------------------------------------------
+
+    teams.sort(key=lambda team: -sum(map(unit_count, team)))
+    distribution = []
+    for team in teams:
+        subteams = pack_subteams([kruh for unit in team for kruh in unit], num_subteams, max_subteam_size)
+        subteams.sort(key=lambda subteam: -sum(kruh.count for kruh in subteam))
+        distribution.append([subteam for subteam in subteams if subteam])
+
+    # - Lower bound: the fewest Teams that can fit everyone, each having at least one Obor and each Obor being somewhere
+    min_teams = max(1, bins_lower_bound([unit_count(unit) for unit in units], num_subteams * max_subteam_size))
+    bound = min_teams + max(min_teams, len(obor_totals))
+    objective = sum(map(team_cost, teams))
+
+    status = Solution.Status.OPTIMAL if objective <= bound else Solution.Status.FEASIBLE
+    solution = Solution(num_teams, max_subteam_size, status, distribution, objective=objective, bound=bound)
+    return solution
+
+
+def pack_subteams_exact(kruhy: list[Kruh], num_subteams: int, max_subteam_size: int, time_limit: float) -> list[list[Kruh]] | Solution.Status:
+    # - The packing, or the status (INFEASIBLE or UNKNOWN) when there is none
+    subteams = pack_subteams(kruhy, num_subteams, max_subteam_size)
+    if subteams is not None:
+        return subteams
+
+    model = cp_model.CpModel()
+    as_kruh_subteam = {(kruh.id, subteam): model.new_bool_var(f"@KruhSubteam[{kruh.id},{subteam}]")
+                       for kruh in kruhy for subteam in range(num_subteams)}
+    for kruh in kruhy:
+        model.add_exactly_one([as_kruh_subteam[kruh.id, subteam] for subteam in range(num_subteams)])
+    for subteam in range(num_subteams):
+        model.add(cp_model.LinearExpr.weighted_sum([as_kruh_subteam[kruh.id, subteam] for kruh in kruhy],
+                                                   [kruh.count for kruh in kruhy]) <= max_subteam_size)
+
+    solver = cp_model.CpSolver()
+    solver.parameters.max_time_in_seconds = time_limit
+    solver.parameters.num_workers = 1
+    status = solver.solve(model)
+    if status != cp_model.OPTIMAL and status != cp_model.FEASIBLE:
+        return Solution.Status(status)
+    return [[kruh for kruh in kruhy if solver.boolean_value(as_kruh_subteam[kruh.id, subteam])] for subteam in range(num_subteams)]
+
+
+def minimal_unpackable(kruhy: list[Kruh], num_subteams: int, max_subteam_size: int, time_limit: float) -> list[Kruh]:
+    # - Drops Kruhy (smallest first) while the rest still provably cannot be packed, for a stronger cut
+    kruhy = sorted(kruhy, key=lambda kruh: kruh.count)
+    for kruh in list(kruhy):
+        rest = [other for other in kruhy if other is not kruh]
+        if pack_subteams_exact(rest, num_subteams, max_subteam_size, time_limit) == Solution.Status.INFEASIBLE:
+            kruhy = rest
+    return kruhy
+
+
+def compute_teams_distribution_decomposed(num_teams: int, max_subteam_size: int, kruhy: list[Kruh], kruhy_friends: list[list[Kruh]], config: dict, options: SolverOptions = None,
+                                          hint: T_Distribution = None) -> Solution:
+    if options is None:
+        options = SolverOptions()
+
+    num_subteams = config["Subteams count"]
+    t_end = time.time() + options.time_limit
+
+    # Stage 1 - Teams --------------------------------------------------------------------------------------------------
+
+    model = cp_model.CpModel()
+
+    lst_teams = list(range(num_teams))
+
+    as_kruh_team = {(kruh.id, team): model.new_bool_var(f"@KruhTeam[{kruh.id},{team}]") for kruh in kruhy for team in lst_teams}
+    vs_team_used = {team: model.new_bool_var(f"TeamUsed[{team}]") for team in lst_teams}
+    as_team_obor = {(team, obor): model.new_bool_var(f"TeamObor[{team},{obor}]") for team in lst_teams for obor in Obor}
+
+    def team_load(team: int) -> cp_model.LinearExpr:
+        return cp_model.LinearExpr.weighted_sum([as_kruh_team[kruh.id, team] for kruh in kruhy], [kruh.count for kruh in kruhy])
+
+    # - Each Kruh is in exactly one Team
+    for kruh in kruhy:
+        model.add_exactly_one([as_kruh_team[kruh.id, team] for team in lst_teams])
+
+    # - Kruh in Team marks its Obor in the Team, any Obor in Team marks the Team used
+    for team in lst_teams:
+        for kruh in kruhy:
+            model.add_implication(as_kruh_team[kruh.id, team], as_team_obor[team, kruh.obor])
+        for obor in Obor:
+            model.add_implication(as_team_obor[team, obor], vs_team_used[team])
+
+    # - Team size must not exceed the capacity of its Subteams,
+    #   Kruhy larger than half of a Subteam need a Subteam each
+    for team in lst_teams:
+        model.add(team_load(team) <= num_subteams * max_subteam_size)
+        model.add(cp_model.LinearExpr.sum([as_kruh_team[kruh.id, team] for kruh in kruhy if 2 * kruh.count > max_subteam_size]) <= num_subteams)
+
+    # - Friends must be in a same Team
+    for friends in kruhy_friends:
+        for friend1, friend2 in zip(friends, friends[1:]):
+            for team in lst_teams:
+                model.add(as_kruh_team[friend1.id, team] == as_kruh_team[friend2.id, team])
+
+    # - Symmetry breaking teams used consecutively and ordered by non-increasing size
+    for team1, team2 in zip(lst_teams, lst_teams[1:]):
+        model.add_implication(vs_team_used[team2], vs_team_used[team1])
+        model.add(team_load(team1) >= team_load(team2))
+
+    model.minimize(
+        cp_model.LinearExpr.sum(list(vs_team_used.values()))
+        + cp_model.LinearExpr.sum(list(as_team_obor.values()))
+    )
+
+    if hint is not None:
+        # - Stage 1 orders the Teams by size, as the compact formulation does
+        for kruh_id, (kruh_team, _) in remap_distribution(hint, kruhy, kruhy_friends, num_teams, num_subteams, max_subteam_size,
+                                                          Formulation.COMPACT).items():
+            for team in lst_teams:
+                model.add_hint(as_kruh_team[kruh_id, team], team == kruh_team)
+
+    # Stage 2 - Subteams, with feedback cuts to stage 1 ----------------------------------------------------------------
+    # - Stage 1 is solved in slices; a distribution which packs is kept and stage 1 is then asked to improve upon it
+
+    expression_objective = (cp_model.LinearExpr.sum(list(vs_team_used.values()))
+                            + cp_model.LinearExpr.sum(list(as_team_obor.values())))
+    solver = make_solver(options)
+
+    num_cuts = 0
+    best = None
+    proven = False  # - no distribution better than best, or none at all
+    status = cp_model.UNKNOWN
+    with concurrent.futures.ThreadPoolExecutor(max_workers=available_workers(options)) as executor:
+        while (time_left := t_end - time.time()) > 0:
+            solver.parameters.max_time_in_seconds = min(time_left, options.time_limit / 4)
+            status = solver.solve(model)
+            if status == cp_model.INFEASIBLE:
+                # - The cuts only remove distributions which cannot be packed, nor does the objective cut remove better ones
+                proven = True
+                break
+            if status != cp_model.OPTIMAL and status != cp_model.FEASIBLE:
+                continue
+
+            teams = [[kruh for kruh in kruhy if solver.boolean_value(as_kruh_team[kruh.id, team])] for team in lst_teams]
+            teams = [team for team in teams if team]
+            packings = list(executor.map(lambda team: pack_subteams_exact(team, num_subteams, max_subteam_size, max(0.1, t_end - time.time())),
+                                         teams))
+            unpacked = [team for team, packing in zip(teams, packings) if packing == Solution.Status.INFEASIBLE]
+            if not unpacked and not all(isinstance(packing, list) for packing in packings):
+                # - A packing neither found nor disproved ran out of the time left, the same Teams would only be solved again
+                break
+            if not unpacked:
+                distribution = [sorted([subteam for subteam in packing if subteam], key=lambda subteam: -sum(kruh.count for kruh in subteam))
+                                for packing in packings]
+                best = Solution(num_teams, max_subteam_size, Solution.Status.FEASIBLE, distribution,
+                                objective=solver.objective_value, bound=solver.best_objective_bound)
+                if status == cp_model.OPTIMAL:
+                    proven = True
+                    break
+                model.add(expression_objective <= int(solver.objective_value) - 1)
+            else:
+                # - The Kruhy of a Team which cannot be packed into its Subteams must never be all together in one Team
+                unpacked = executor.map(lambda team: minimal_unpackable(team, num_subteams, max_subteam_size, max(0.1, t_end - time.time())),
+                                        unpacked)
+                for team_kruhy in unpacked:
+                    for team in lst_teams:
+                        model.add(cp_model.LinearExpr.sum([as_kruh_team[kruh.id, team] for kruh in team_kruhy]) <= len(team_kruhy) - 1)
+                    num_cuts += 1
+
+            model.clear_hints()
+            for kruh in kruhy:
+                for team in lst_teams:
+                    model.add_hint(as_kruh_team[kruh.id, team], solver.boolean_value(as_kruh_team[kruh.id, team]))
+
+    # Solution ---------------------------------------------------------------------------------------------------------
+
+    if best is not None:
+        solution = best
+        # - Stage 1 proved there is no better distribution than the best one packed
+        if proven:
+            solution.status = Solution.Status.OPTIMAL
+            solution.bound = solution.objective
+    elif proven:
+        solution = Solution(num_teams, max_subteam_size, Solution.Status.INFEASIBLE, [])
+    else:
+        solution = Solution(num_teams, max_subteam_size, Solution.Status.UNKNOWN, [])
+    solution.num_variables, solution.num_constraints = len(model.proto.variables), len(model.proto.constraints)
+    if num_cuts:
+        solution.note = f"decomposed: {num_cuts} Teams could not be packed into Subteams and were cut"
+    return solution
+
+
+@dataclass
+class DistributionModel:
+    model: cp_model.CpModel
+    kruhy: list[Kruh]
+    num_teams: int
+    num_subteams: int
+    assignment: dict[tuple[int, int, int], cp_model.IntVar]  # (kruh.id, team, subteam) -> is Kruh in Team-Subteam
+    team_used: dict[int, cp_model.IntVar]
+    team_obor: dict[tuple[int, Obor], cp_model.IntVar]
+    expression_used_team_count: cp_model.LinearExpr
+    expression_team_obory_sum: cp_model.LinearExpr
+    subteam_loads: dict[tuple[int, int], cp_model.LinearExpr]  # (team, subteam) -> number of people
+    channels: dict[str, dict] = field(default_factory=dict)  # formulation specific variables, see hint_channels
+
+    def size(self) -> tuple[int, int]:
+        return len(self.model.proto.variables), len(self.model.proto.constraints)
+
+    def expression_subteam_balance(self, max_subteam_size: int) -> cp_model.LinearExpr:
+        # - Sum over Teams of the difference between their largest and smallest Subteam,
+        #   only added to the model when balancing is asked for
+        spreads = []
+        for team in range(self.num_teams):
+            loads = [self.subteam_loads[team, subteam] for subteam in range(self.num_subteams)]
+            v_load_max = self.model.new_int_var(0, max_subteam_size, f"SubteamLoadMax[{team}]")
+            v_load_min = self.model.new_int_var(0, max_subteam_size, f"SubteamLoadMin[{team}]")
+            self.model.add_max_equality(v_load_max, loads)
+            self.model.add_min_equality(v_load_min, loads)
+            spreads.append(v_load_max - v_load_min)
+        return cp_model.LinearExpr.sum(spreads)
+
+    def add_hint(self, placement: dict[int, tuple[int, int]]):
+        for (kruh_id, team, subteam), literal in self.assignment.items():
+            if kruh_id in placement:
+                self.model.add_hint(literal, placement[kruh_id] == (team, subteam))
+
+        # - Derived variables are only hinted for a complete placement, a partial one is completed by the solver
+        if any(kruh.id not in placement for kruh in self.kruhy):
+            return
+        teams_obory = defaultdict(set)
+        for kruh in self.kruhy:
+            teams_obory[placement[kruh.id][0]].add(kruh.obor)
+        for team in range(self.num_teams):
+            self.model.add_hint(self.team_used[team], team in teams_obory)
+            for obor in Obor:
+                self.model.add_hint(self.team_obor[team, obor], obor in teams_obory[team])
+        for var, value in hint_channels(self.channels, placement, self.kruhy):
+            self.model.add_hint(var, value)
+
+    def extract_distribution(self, solver: cp_model.CpSolver) -> T_Distribution:
+        kruhy = {kruh.id: kruh for kruh in self.kruhy}
+        teams = defaultdict(lambda: defaultdict(list))
+        for (kruh_id, team, subteam), literal in self.assignment.items():
+            if solver.boolean_value(literal):
+                teams[team][subteam].append(kruhy[kruh_id])
+
+        distribution = [[[kruh for kruh in kruhs]
+                         for subteam, kruhs in sorted(subteams.items())]
+                        for team, subteams in sorted(teams.items())]
+        return distribution
+
+
+def hint_channels(channels: dict[str, dict], placement: dict[int, tuple[int, int]], kruhy: list[Kruh]):
+    num_subteams = 1 + max((subteam for _, subteam in channels.get("@KruhSubteam", {})), default=0)
+    used_subteams = {placement[kruh.id] for kruh in kruhy}
+    for name, variables in channels.items():
+        for key, var in variables.items():
+            match name:
+                case "KruhTeam":
+                    value = placement[key][0]
+                case "KruhSubteam":
+                    value = placement[key][1]
+                case "KruhOrder":
+                    value = placement[key][0] * num_subteams + placement[key][1]
+                case "@KruhTeam":
+                    value = placement[key[0]][0] == key[1]
+                case "@KruhSubteam":
+                    value = placement[key[0]][1] == key[1]
+                case "TeamSubteamUsed":
+                    value = key in used_subteams
+                case _:
+                    continue
+            yield var, value
+
+
+def build_model_element(num_teams: int, num_subteams: int, max_subteam_size: int, kruhy: list[Kruh], kruhy_friends: list[list[Kruh]]) -> DistributionModel:
     model = cp_model.CpModel()
 
     dom_teams = cp_model.Domain.from_values(list(range(num_teams)))
@@ -238,6 +1609,7 @@ def compute_teams_distribution(num_teams: int, max_subteam_size: int, kruhy: lis
 
     # Constraints
     # - Team size must not exceed max_team_size
+    exprs_subteam_size = {}
     for team in lst_teams:
         for subteam in lst_subteams:
             expr_subteam_size = cp_model.LinearExpr.sum(
@@ -246,6 +1618,7 @@ def compute_teams_distribution(num_teams: int, max_subteam_size: int, kruhy: lis
             model.add(
                 expr_subteam_size <= max_subteam_size
             )
+            exprs_subteam_size[team, subteam] = expr_subteam_size
 
     # - Friends must be in a same Team
     for friends in kruhy_friends:
@@ -284,41 +1657,305 @@ def compute_teams_distribution(num_teams: int, max_subteam_size: int, kruhy: lis
         [as_team_obor[team, obor] for team in lst_teams for obor in lst_obory]
     )
 
-    # - Minimize small Subteams
-    # expression_subteam_size_diff = cp_model.LinearExpr.sum([
-    #     (max_subteam_size - cp_model.LinearExpr.sum(
-    #         [kruh.count * as_kruh_team_subteam[kruh.id, team, subteam] for kruh in kruhy]
-    #     )) * subteam
-    #     for team in lst_teams for subteam in lst_subteams
-    # ])
+    # - Balance Subteams, see DistributionModel.expression_subteam_balance
 
-    model.minimize(
-        expression_used_team_count
-        + expression_team_obory_sum
-        # + expression_subteam_size_diff
-    )
+    return DistributionModel(model, kruhy, num_teams, num_subteams,
+                             as_kruh_team_subteam, vs_team_used,
+                             {(team, obor): as_team_obor[team, obor_mapping[obor]] for team in lst_teams for obor in Obor},
+                             expression_used_team_count, expression_team_obory_sum, exprs_subteam_size,
+                             {
+                                 "KruhTeam": vs_kruh_team,
+                                 "KruhSubteam": vs_kruh_subteam,
+                                 "KruhOrder": vs_kruh_order,
+                                 "@KruhTeam": as_kruh_team,
+                                 "@KruhSubteam": as_kruh_subteam,
+                                 "TeamSubteamUsed": vs_team_subteam_used,
+                             })
 
-    # Solve ------------------------------------------------------------------------------------------------------------
 
-    solver = cp_model.CpSolver()
-    solver.parameters.max_time_in_seconds = SOLVER_TIME_LIMIT
+def build_model_compact(num_teams: int, num_subteams: int, max_subteam_size: int, kruhy: list[Kruh], kruhy_friends: list[list[Kruh]],
+                        allowed: dict[int, list[tuple[int, int]]] = None) -> DistributionModel:
+    model = cp_model.CpModel()
 
-    status = solver.solve(model)
+    lst_teams = list(range(num_teams))
+    lst_subteams = list(range(num_subteams))
+    all_placements = list(itertools.product(lst_teams, lst_subteams))
+    if allowed is None:
+        allowed = {}
 
-    # Solution ---------------------------------------------------------------------------------------------------------
+    # Variables
+    # - Only the (Kruh, Team, Subteam) assignment literals of the allowed placements;
+    #   team membership is their sum over Subteams
+    as_kruh_team_subteam = {}
+    kruh_team_literals = defaultdict(list)
+    subteam_kruhy = defaultdict(list)
+    for kruh in kruhy:
+        for team, subteam in allowed.get(kruh.id, all_placements):
+            a_kruh_team_subteam = model.new_bool_var(f"@KruhTeamSubteam[{kruh.id},{team},{subteam}]")
+            as_kruh_team_subteam[kruh.id, team, subteam] = a_kruh_team_subteam
+            kruh_team_literals[kruh.id, team].append(a_kruh_team_subteam)
+            subteam_kruhy[team, subteam].append((kruh, a_kruh_team_subteam))
 
-    distribution = []
-    if status == cp_model.OPTIMAL or status == cp_model.FEASIBLE:
-        teams = defaultdict(lambda: defaultdict(list))
-        for kruh in kruhy:
-            teams[solver.value(vs_kruh_team[kruh.id])][solver.value(vs_kruh_subteam[kruh.id])].append(kruh)
+    vs_team_used = {team: model.new_bool_var(f"TeamUsed[{team}]") for team in lst_teams}
+    as_team_obor = {(team, obor): model.new_bool_var(f"TeamObor[{team},{obor}]") for team in lst_teams for obor in Obor}
 
-        distribution = [[[kruh for kruh in kruhs]
-                         for subteam, kruhs in sorted(subteams.items())]
-                        for team, subteams in sorted(teams.items())]
+    def kruh_in_team(kruh: Kruh, team: int) -> cp_model.LinearExpr:
+        return cp_model.LinearExpr.sum(kruh_team_literals.get((kruh.id, team), []))
 
-    solution = Solution(num_teams, max_subteam_size, Solution.Status(status), distribution)
-    return solution
+    def subteam_load(team: int, subteam: int) -> cp_model.LinearExpr:
+        members = subteam_kruhy.get((team, subteam), [])
+        return cp_model.LinearExpr.weighted_sum([literal for _, literal in members], [kruh.count for kruh, _ in members])
+
+    # Constraints
+    # - Each Kruh is in exactly one Team-Subteam
+    for kruh in kruhy:
+        model.add_exactly_one([as_kruh_team_subteam[kruh.id, team, subteam] for team, subteam in allowed.get(kruh.id, all_placements)])
+
+    # - Kruh in Team marks its Obor in the Team, any Obor in Team marks the Team used
+    for kruh in kruhy:
+        for team in {team for team, _ in allowed.get(kruh.id, all_placements)}:
+            model.add(kruh_in_team(kruh, team) <= as_team_obor[team, kruh.obor])
+    for team in lst_teams:
+        for obor in Obor:
+            model.add_implication(as_team_obor[team, obor], vs_team_used[team])
+
+    # - Subteam size must not exceed max_subteam_size
+    for team, subteam in all_placements:
+        model.add(subteam_load(team, subteam) <= max_subteam_size)
+
+    # - Friends must be in a same Team
+    for friends in kruhy_friends:
+        for friend1, friend2 in zip(friends, friends[1:]):
+            for team in lst_teams:
+                model.add(kruh_in_team(friend1, team) == kruh_in_team(friend2, team))
+
+    # - Symmetry breaking is only valid when any Kruh can be placed anywhere
+    if not allowed:
+        # - Symmetry breaking teams used consecutively
+        for team1, team2 in zip(lst_teams, lst_teams[1:]):
+            model.add_implication(vs_team_used[team2], vs_team_used[team1])
+
+        # - Symmetry breaking Teams and Subteams ordered by non-increasing size
+        team_loads = [cp_model.LinearExpr.sum([subteam_load(team, subteam) for subteam in lst_subteams]) for team in lst_teams]
+        for team1, team2 in zip(lst_teams, lst_teams[1:]):
+            model.add(team_loads[team1] >= team_loads[team2])
+        for team in lst_teams:
+            for subteam1, subteam2 in zip(lst_subteams, lst_subteams[1:]):
+                model.add(subteam_load(team, subteam1) >= subteam_load(team, subteam2))
+
+    # Objective
+    expression_used_team_count = cp_model.LinearExpr.sum(list(vs_team_used.values()))
+    expression_team_obory_sum = cp_model.LinearExpr.sum(list(as_team_obor.values()))
+
+    return DistributionModel(model, kruhy, num_teams, num_subteams,
+                             as_kruh_team_subteam, vs_team_used, as_team_obor,
+                             expression_used_team_count, expression_team_obory_sum,
+                             {(team, subteam): subteam_load(team, subteam) for team, subteam in all_placements})
+
+
+MODEL_BUILDERS = {
+    Formulation.ELEMENT: build_model_element,
+    Formulation.COMPACT: build_model_compact,
+}
+
+_parametric_models: dict[tuple, DistributionModel] = {}
+
+
+def build_model_parametric(num_teams: int, num_subteams: int, max_subteam_size: int, kruhy: list[Kruh], kruhy_friends: list[list[Kruh]],
+                           formulation: Formulation, max_num_teams: int) -> DistributionModel:
+    # - The model is built once per Subteam size with the most Teams and kept in the process,
+    #   each Teams count gets a copy with the trailing TeamUsed literals fixed to false (emptying those Teams,
+    #   presolve removes their constraints). The copy has the Teams count of the point, so that the terms added
+    #   to it later (the Subteams balance and its objective weight) only cover the Teams which may be used
+    key = (formulation, num_subteams, max_subteam_size, max_num_teams,
+           tuple((kruh.id, kruh.count, kruh.obor) for kruh in kruhy),
+           tuple(tuple(kruh.id for kruh in friends) for friends in kruhy_friends))
+    if key not in _parametric_models:
+        if len(_parametric_models) >= PARAMETRIC_MODELS_CACHED:
+            del _parametric_models[next(iter(_parametric_models))]
+        _parametric_models[key] = MODEL_BUILDERS[formulation](max_num_teams, num_subteams, max_subteam_size, kruhy, kruhy_friends)
+        num_variables, num_constraints = _parametric_models[key].size()
+        instrument.count("variables", num_variables)
+        instrument.count("constraints", num_constraints)
+
+    parametric = _parametric_models[key]
+    dmodel = replace(parametric, model=parametric.model.clone(), num_teams=num_teams)
+    for team in range(num_teams, max_num_teams):
+        domain = dmodel.model.proto.variables[dmodel.team_used[team].index].domain
+        domain.clear()
+        domain.extend([0, 0])
+    return dmodel
+
+ENGINES = {
+    Engine.CPSAT: compute_teams_distribution,
+    Engine.HEURISTIC: compute_teams_distribution_heuristic,
+    Engine.HYBRID: compute_teams_distribution,
+    Engine.DECOMPOSED: compute_teams_distribution_decomposed,
+}
+
+# CACHE ================================================================================================================
+
+@dataclass
+class SolutionCache:
+    directory: str
+    max_age: float = 30 * 24 * 3600  # seconds
+    max_size: int = 100 * 1024 * 1024  # bytes
+
+    @staticmethod
+    def key(kruhy: list[Kruh], config: dict, num_teams: int, max_subteam_size: int, options: SolverOptions) -> str:
+        content = {
+            "version": MODEL_VERSION,
+            "counts": sorted((kruh.id, kruh.count) for kruh in kruhy),
+            "obory": sorted((obor["Name"], sorted(obor["Kruhy"])) for obor in config["Obory"]),
+            "subteams": config["Subteams count"],
+            "point": [num_teams, max_subteam_size],
+            "solver": options.signature(),
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def load(self, key: str) -> tuple[Solution, float] | None:
+        try:
+            with instrument.span("cache load"), open(self.path(key), "r", encoding="utf8") as file:
+                entry = json.load(file)
+            # - The age of an entry is the time since it was last used, as for the eviction
+            age = time.time() - os.path.getmtime(self.path(key))
+        except (OSError, ValueError):
+            return None
+        if age > self.max_age:
+            return None
+
+        os.utime(self.path(key))  # - eviction removes the least recently used entries
+        solution = solution_from_dict(entry["solution"])
+        solution.note = entry.get("note")
+        return solution, entry["time_limit"]
+
+    def store(self, key: str, solution: Solution, time_limit: float):
+        os.makedirs(self.directory, exist_ok=True)
+        entry = {
+            "created": time.time(),
+            "time_limit": time_limit,
+            "solution": solution_to_dict(solution),
+            "note": solution.note,
+        }
+        # - Written aside and renamed, so that an interrupted run never leaves a corrupt entry
+        tmp_path = f"{self.path(key)}.{os.getpid()}.tmp"
+        with instrument.span("cache store"), open(tmp_path, "w", encoding="utf8") as file:
+            json.dump(entry, file)
+        os.replace(tmp_path, self.path(key))
+
+    def evict(self):
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            stat = entry.stat()
+            if time.time() - stat.st_mtime > self.max_age:
+                os.remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(path)
+            total_size -= size
+
+# SNAPSHOTS ============================================================================================================
+
+def write_snapshot(model: cp_model.CpModel, solver: cp_model.CpSolver, status: int, solution: Solution, elapsed: float,
+                   kruhy: list[Kruh], kruhy_friends: list[list[Kruh]], hint: T_Distribution | None,
+                   num_subteams: int, max_num_teams: int, options: SolverOptions) -> str | None:
+    # - The model as the first stage solved it (.pbtxt) and the instance it was built from (.json),
+    #   named by the instance, so that solving it again replaces the older snapshot
+    solved_quickly = solution.status == Solution.Status.OPTIMAL and elapsed <= SNAPSHOT_HARD_TIME
+    if options.snapshot_hard and solved_quickly:
+        return None
+
+    point = [solution.num_teams, solution.max_subteam_size]
+    instance = {
+        "point": point,
+        "num_subteams": num_subteams,
+        "max_num_teams": max_num_teams,
+        "kruhy": [[kruh.id, kruh.count, str(kruh.obor)] for kruh in kruhy],
+        "kruhy_friends": [[kruh.id for kruh in friends] for friends in kruhy_friends],
+        "solver": options.signature(),
+    }
+    digest = hashlib.sha256(json.dumps(instance, sort_keys=True).encode("utf8")).hexdigest()
+    stem = os.path.join(options.snapshot_dir, f"snapshot-{point[0]}_{point[1]}-{digest[:12]}")
+    os.makedirs(options.snapshot_dir, exist_ok=True)
+
+    # - The file type is given by the extension, so the temporary name ends in .pbtxt as well
+    model.export_to_file(f"{stem}.tmp.pbtxt")
+    os.replace(f"{stem}.tmp.pbtxt", f"{stem}.pbtxt")
+
+    model_result = {"status": Solution.Status(status).name, "objective": None, "bound": None}
+    if status in {cp_model.OPTIMAL, cp_model.FEASIBLE}:
+        model_result |= {"objective": solver.objective_value, "bound": solver.best_objective_bound}
+    metadata = instance | {
+        "version": SNAPSHOT_VERSION,
+        "model_version": MODEL_VERSION,
+        "model": os.path.basename(f"{stem}.pbtxt"),
+        "hint": [[[[kruh.id, kruh.count, str(kruh.obor)] for kruh in subteam] for subteam in team] for team in hint]
+                if hint is not None else None,
+        "options": {
+            "time_limit": options.time_limit,
+            "num_workers": options.num_workers,
+            "profile": str(options.profile),
+            "gap_limit": options.gap_limit,
+        },
+        "model_result": model_result,
+        "result": solution_to_dict(solution) | {"time": elapsed, "build_time": solution.build_time,
+                                                "first_solution_time": solution.first_solution_time},
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    # - Written last, a snapshot is complete once its metadata exists
+    with open(f"{stem}.tmp.json", "w", encoding="utf8") as file:
+        json.dump(metadata, file, ensure_ascii=False)
+    os.replace(f"{stem}.tmp.json", f"{stem}.json")
+    return f"{stem}.json"
+
+
+def read_snapshot(filename: str) -> dict:
+    with open(filename, "r", encoding="utf8") as file:
+        metadata = json.load(file)
+    if metadata.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"[{filename}] is a snapshot of version {metadata.get('version')}, expected {SNAPSHOT_VERSION}")
+    metadata["path"] = filename
+    return metadata
+
+
+def snapshot_model(metadata: dict) -> cp_model.CpModel:
+    model = cp_model.CpModel()
+    with open(os.path.join(os.path.dirname(metadata["path"]), metadata["model"]), "r", encoding="utf8") as file:
+        model.proto.parse_text_format(file.read())
+    return model
+
+
+def snapshot_options(metadata: dict) -> SolverOptions:
+    solver, options = metadata["solver"], metadata["options"]
+    return SolverOptions(time_limit=options["time_limit"], num_workers=options["num_workers"],
+                         formulation=Formulation(solver["formulation"]), engine=Engine(solver["engine"]),
+                         profile=SolverProfile(options["profile"]), objective=Objective(solver["objective"]),
+                         balance_subteams=solver["balance_subteams"], gap_limit=options["gap_limit"])
+
+
+def snapshot_instance(metadata: dict) -> tuple[list[Kruh], list[list[Kruh]], T_Distribution | None, dict]:
+    # - The Kruhy already split, with the part of the config the engines read
+    kruhy = [Kruh(kruh_id, count, Obor(obor)) for kruh_id, count, obor in metadata["kruhy"]]
+    kruhy_by_id = {kruh.id: kruh for kruh in kruhy}
+    kruhy_friends = [[kruhy_by_id[kruh_id] for kruh_id in friends] for friends in metadata["kruhy_friends"]]
+    hint = None
+    if metadata["hint"] is not None:
+        hint = [[[Kruh(kruh_id, count, Obor(obor)) for kruh_id, count, obor in subteam] for subteam in team]
+                for team in metadata["hint"]]
+    config = {"Subteams count": metadata["num_subteams"], "Possible Teams counts": [metadata["max_num_teams"]]}
+    return kruhy, kruhy_friends, hint, config
 
 # OUTPUT ===============================================================================================================
 
@@ -351,21 +1988,22 @@ class Format:
         "font_color": "#ff0000",
     }
 
-    @staticmethod
-    def init(workbook: xlsxwriter.Workbook):
+    def __init__(self, workbook: xlsxwriter.Workbook):
+        # - Formats belong to their workbook, each workbook gets its own instance
         def make_obor(obor: Obor):
             return Format.Obor._common | {"bg_color": Format.Obor._colors[obor]}
 
-        Format.Obor.dictionary = {obor: workbook.add_format(make_obor(obor)) for obor in Obor}
-        Format.team = workbook.add_format(Format._team)
-        Format.count = workbook.add_format(Format._count)
-        Format.subteam_overflow = workbook.add_format(Format._subteam_overflow)
+        self.obory = {obor: workbook.add_format(make_obor(obor)) for obor in Obor}
+        self.team = workbook.add_format(Format._team)
+        self.count = workbook.add_format(Format._count)
+        self.subteam_overflow = workbook.add_format(Format._subteam_overflow)
 
+    @staticmethod
     def format_kruh(kruh):
-        if kruh.id < 100:
+        if kruh.id >= 0:
             return str(kruh.id)
         else:
-            kruh_id, kruh_part = divmod(kruh.id, 100)
+            kruh_id, kruh_part = split_kruh_id(kruh.id)
             kruh_part = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'][kruh_part]
             return f"{kruh_id}[{kruh_part}]"
 
@@ -375,50 +2013,58 @@ def write_kruhy_table(worksheet: xlsxwriter.worksheet.Worksheet, solution: Solut
 
     worksheet.write(0, 0, "Kruh")
     worksheet.write(0, 1, "Size")
-    kruhy_sorted = sorted(kruhy, key=lambda k: k.id)
+    kruhy_sorted = sorted(kruhy, key=lambda k: split_kruh_id(k.id))
     for i_kruh, kruh in enumerate(kruhy_sorted):
         worksheet.write_string(1 + i_kruh, 0,
                                Format.format_kruh(kruh))
         worksheet.write_number(1 + i_kruh, 1,
                                kruh.count)
     worksheet.write_number(1 + i_kruh + 1, 1, 0)
+    instrument.count("cells", 2 + 2 * len(kruhy) + 1)
 
 
-def write_solution(solution: Solution, worksheet: xlsxwriter.worksheet.Worksheet, config: dict):
+def write_solution(solution: Solution, worksheet: xlsxwriter.worksheet.Worksheet, config: dict, formats: Format,
+                   static_totals: bool = False):
     team_names = config["Teams names"]
 
     distribution = solution.distribution
     num_teams = len(distribution)
     num_subteams = config["Subteams count"]
     num_kruhy = sum(1 for team in distribution for subteam in team for kruh in subteam)
+    instrument.count("cells", num_teams * (1 + num_subteams) + num_kruhy)
+    kruhy_table = f"\'Kruhy-{solution.num_teams}_{solution.max_subteam_size}\'"
 
+    # - Written strictly row by row, as the workbook streams each finished row to disk (constant_memory)
     for i_team, team in enumerate(distribution):
         row_team = i_team*num_subteams
 
+        # - Without a format the merge pads no blank cells into the later rows, they get them in their turn
         worksheet.merge_range(row_team, 0,
                               row_team + num_subteams -1, 0,
-                              team_names[i_team],
-                              cell_format=Format.team)
+                              None)
+        worksheet.write_string(row_team, 0, team_names[i_team], formats.team)
 
-        for i_subteam, subteam in enumerate(team):
+        for i_subteam in range(num_subteams):
             row_subteam = row_team + i_subteam
-            worksheet.write(
-                row_subteam, 1,
-                f"=SUM(XLOOKUP(C{1+row_subteam}:Z{1+row_subteam}, \'Kruhy-{solution.num_teams}_{solution.max_subteam_size}\'!A1:A{1+num_kruhy+1}, \'Kruhy-{solution.num_teams}_{solution.max_subteam_size}\'!B1:B{1+num_kruhy+1}))",
-                Format.count
-            )
+            subteam = team[i_subteam] if i_subteam < len(team) else []
+            if i_subteam > 0:
+                worksheet.write_blank(row_subteam, 0, None, formats.team)
+
+            # - The total is stored as the cached result, so that the workbook shows it without recalculation
+            total = sum(kruh.count for kruh in subteam)
+            if static_totals:
+                worksheet.write_number(row_subteam, 1, total, formats.count)
+            else:
+                worksheet.write_formula(
+                    row_subteam, 1,
+                    f"=SUM(XLOOKUP(C{1+row_subteam}:Z{1+row_subteam}, {kruhy_table}!A1:A{1+num_kruhy+1}, {kruhy_table}!B1:B{1+num_kruhy+1}))",
+                    formats.count,
+                    total
+                )
             for i_kruh, kruh in enumerate(subteam):
                 worksheet.write_string(row_subteam, 2 + i_kruh,
                                        Format.format_kruh(kruh),
-                                       Format.Obor.dictionary[kruh.obor])
-
-        for i_subteam in range(i_subteam+1, num_subteams):
-            row_subteam = row_team + i_subteam
-            worksheet.write(
-                row_subteam, 1,
-                f"=SUM(XLOOKUP(C{1+row_subteam}:Z{1+row_subteam}, \'Kruhy-{solution.num_teams}_{solution.max_subteam_size}\'!A1:A{1+num_kruhy+1}, \'Kruhy-{solution.num_teams}_{solution.max_subteam_size}\'!B1:B{1+num_kruhy+1}))",
-                Format.count
-            )
+                                       formats.obory[kruh.obor])
 
     worksheet.conditional_format(0, 1,
                                  num_teams * num_subteams - 1, 1,
@@ -435,41 +2081,373 @@ def write_solution(solution: Solution, worksheet: xlsxwriter.worksheet.Worksheet
                                      'type': 'cell',
                                      'criteria': 'greater than',
                                      'value': solution.max_subteam_size,
-                                     'format': Format.subteam_overflow,
+                                     'format': formats.subteam_overflow,
                                  })
 
 
-def write_solutions(filename: str, solutions: list[Solution], config: dict):
-    workbook = xlsxwriter.Workbook(filename)
-    Format.init(workbook)
+def write_summary(worksheet: xlsxwriter.worksheet.Worksheet, solutions: list[Solution]):
+    headers = ["#Teams", "Max Subteam size", "Status", "Used Teams", "Objective", "Bound", "Time [s]", "Note"]
+    for i_header, header in enumerate(headers):
+        worksheet.write_string(0, i_header, header)
+
+    for i_solution, solution in enumerate(solutions):
+        row = 1 + i_solution
+        worksheet.write_number(row, 0, solution.num_teams)
+        worksheet.write_number(row, 1, solution.max_subteam_size)
+        worksheet.write_string(row, 2, solution.status.name)
+        if solution.distribution:
+            worksheet.write_number(row, 3, len(solution.distribution))
+        if solution.objective is not None:
+            worksheet.write_number(row, 4, solution.objective)
+        if solution.bound is not None:
+            worksheet.write_number(row, 5, solution.bound)
+        if solution.time is not None:
+            worksheet.write_number(row, 6, round(solution.time, 2))
+        note = solution.error if solution.error is not None else solution.note
+        if note is not None:
+            worksheet.write_string(row, 7, note)
+    worksheet.set_column(7, 7, 60)
+
+
+def write_workbook(filename: str, solutions: list[Solution], config: dict, static_totals: bool = False,
+                   summary: bool = True, distributions: bool = True):
+    # - Each row is written to disk once the next one starts, keeping the memory bounded for large sweeps
+    workbook = xlsxwriter.Workbook(filename, {"constant_memory": True})
+    formats = Format(workbook)
+
+    if summary:
+        with instrument.span("summary"):
+            write_summary(workbook.add_worksheet("Summary"), solutions)
 
     for solution in solutions:
-        if not solution.status in {Solution.Status.FEASIBLE, Solution.Status.OPTIMAL}:
+        if not distributions or not solution.status in {Solution.Status.FEASIBLE, Solution.Status.OPTIMAL}:
             continue
 
-        kruhy_table = workbook.add_worksheet(f"Kruhy-{solution.num_teams}_{solution.max_subteam_size}")
-        write_kruhy_table(kruhy_table, solution)
+        with instrument.span("Kruhy tables"):
+            kruhy_table = workbook.add_worksheet(f"Kruhy-{solution.num_teams}_{solution.max_subteam_size}")
+            write_kruhy_table(kruhy_table, solution)
 
-        worksheet = workbook.add_worksheet(f"Teams-{solution.num_teams}_{solution.max_subteam_size}")
-        write_solution(solution, worksheet, config)
+        with instrument.span("Teams worksheets"):
+            worksheet = workbook.add_worksheet(f"Teams-{solution.num_teams}_{solution.max_subteam_size}")
+            write_solution(solution, worksheet, config, formats, static_totals)
 
     try:
-        workbook.close()
+        with instrument.span("close (compression)"):
+            workbook.close()
     except xlsxwriter.exceptions.FileCreateError:
         print(f"[{filename}] cannot be written. It is probably open in another program.")
         sys.exit(1)
 
+
+def write_solutions(filename: str, solutions: list[Solution], config: dict, static_totals: bool = False,
+                    per_point: bool = False, jobs: int = 1):
+    # - With per_point, the file only holds the Summary and each distribution gets a workbook of its own
+    #   (OUTPUT-TEAMS_SIZE.xlsx); independent workbooks are built in parallel processes
+    workbooks = [(filename, solutions, True, not per_point)]
+    if per_point:
+        stem = os.path.splitext(filename)[0]
+        workbooks += [(f"{stem}-{solution.num_teams}_{solution.max_subteam_size}.xlsx", [solution], False, True)
+                      for solution in solutions
+                      if solution.status in {Solution.Status.FEASIBLE, Solution.Status.OPTIMAL}]
+
+    if jobs <= 1 or len(workbooks) <= 1:
+        for workbook_file, workbook_solutions, summary, distributions in workbooks:
+            write_workbook(workbook_file, workbook_solutions, config, static_totals, summary, distributions)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(write_workbook, workbook_file, workbook_solutions, config, static_totals, summary, distributions)
+                   for workbook_file, workbook_solutions, summary, distributions in workbooks]
+        for future in futures:
+            future.result()
+
+
+def write_solutions_json(filename: str, solutions: list[Solution], config: dict = None):
+    with open(filename, "w", encoding="utf8") as file:
+        json.dump({"solutions": [solution_to_dict(solution) for solution in solutions]}, file, ensure_ascii=False)
+
+
+def write_solutions_jsonl(filename: str, solutions: list[Solution], config: dict = None):
+    with open(filename, "w", encoding="utf8") as file:
+        for solution in solutions:
+            file.write(json.dumps(solution_to_dict(solution), ensure_ascii=False) + "\n")
+
+
+def write_solutions_csv(filename: str, solutions: list[Solution], config: dict):
+    # - Written row by row; only the distributions themselves, without the statuses of the other points
+    team_names = config["Teams names"]
+    subteam_names = [subteam["Name"] for subteam in config["Subteams"]]
+    with open(filename, "w", encoding="utf8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(CSV_HEADER)
+        for solution in solutions:
+            for i_team, team in enumerate(solution.distribution):
+                for i_subteam, subteam in enumerate(team):
+                    for kruh in subteam:
+                        kruh_id, kruh_part = split_kruh_id(kruh.id)
+                        writer.writerow([solution.num_teams, solution.max_subteam_size,
+                                         i_team + 1, team_names[i_team], i_subteam + 1, subteam_names[i_subteam],
+                                         kruh_id, kruh_part if kruh.id < 0 else "", kruh.count, str(kruh.obor)])
+
+
+def read_solutions_json(filename: str, config: dict = None) -> list[Solution]:
+    with open(filename, "r", encoding="utf8") as file:
+        data = json.load(file)
+    kruhy_ids = config_kruhy_ids(config) if config is not None else None
+    return [solution_from_dict(solution, kruhy_ids) for solution in data["solutions"]]
+
+
+def read_solutions_jsonl(filename: str, config: dict = None) -> list[Solution]:
+    kruhy_ids = config_kruhy_ids(config) if config is not None else None
+    with open(filename, "r", encoding="utf8") as file:
+        return [solution_from_dict(json.loads(line), kruhy_ids) for line in file if line.strip()]
+
+
+def read_solutions_csv(filename: str, config: dict) -> list[Solution]:
+    # - Teams and Subteams keep their positions, the empty ones are restored from the Subteams count;
+    #   the statuses are not stored, every distribution is read as feasible.
+    #   Kruh and part are separate columns, so split Kruhy read the same whatever their ids were
+    num_subteams = config["Subteams count"]
+    distributions: dict[tuple[int, int], T_Distribution] = {}
+    with open(filename, "r", encoding="utf8", newline="") as file:
+        for row in csv.DictReader(file):
+            point = (int(row["teams"]), int(row["max_subteam_size"]))
+            distribution = distributions.setdefault(point, [])
+            i_team, i_subteam = int(row["team"]) - 1, int(row["subteam"]) - 1
+            while len(distribution) <= i_team:
+                distribution.append([[] for _ in range(num_subteams)])
+            kruh_id = int(row["kruh"]) if row["part"] == "" else split_part_id(int(row["kruh"]), int(row["part"]))
+            distribution[i_team][i_subteam].append(Kruh(kruh_id, int(row["count"]), Obor(row["obor"])))
+    return [Solution(*point, Solution.Status.FEASIBLE, distribution) for point, distribution in distributions.items()]
+
+
+SOLUTION_WRITERS = {
+    OutputFormat.XLSX: write_solutions,
+    OutputFormat.JSON: write_solutions_json,
+    OutputFormat.JSONL: write_solutions_jsonl,
+    OutputFormat.CSV: write_solutions_csv,
+}
+
+SOLUTION_READERS = {
+    OutputFormat.JSON: read_solutions_json,
+    OutputFormat.JSONL: read_solutions_jsonl,
+    OutputFormat.CSV: read_solutions_csv,
+}
+
+
+def output_filename(output: str, output_format: OutputFormat) -> str:
+    if output_format == OutputFormat.XLSX:
+        return output
+    return f"{os.path.splitext(output)[0]}.{output_format}"
+
+
+def read_solutions(filename: str, config: dict) -> list[Solution]:
+    # - The format is given by the extension
+    extension = os.path.splitext(filename)[1].lstrip(".").lower()
+    if extension not in SOLUTION_READERS:
+        print(f"[{filename}] cannot be read, distributions are read from: {', '.join(SOLUTION_READERS)}")
+        sys.exit(1)
+    return SOLUTION_READERS[OutputFormat(extension)](filename, config)
+
+# PROFILES =============================================================================================================
+
+def compare_profiles(counts: dict[int, int], config: dict, jobs: int, options: SolverOptions):
+    # - Each profile solves the whole grid from scratch, without the cache
+    results = {}
+    for profile in SolverProfile:
+        print(f"Solver profile {profile}")
+        t_start = time.time()
+        solutions = compute_distributions(counts, config, jobs, replace(options, profile=profile))
+        results[profile] = (solutions, time.time() - t_start)
+
+    print("Solver profiles:")
+    print(f"> {'profile':<14} {'solved':>6} {'optimal':>7} {'first solution [s]':>18} {'mean gap':>8} {'total [s]':>9}")
+    for profile, (solutions, total_time) in results.items():
+        solved = [solution for solution in solutions if solution.time and solution.distribution]
+        first_times = [solution.first_solution_time for solution in solved if solution.first_solution_time is not None]
+        gaps = [(solution.objective - solution.bound) / max(1.0, solution.objective) for solution in solved
+                if solution.bound is not None]
+        num_optimal = sum(solution.status == Solution.Status.OPTIMAL for solution in solved)
+        first_time = f"{sum(first_times) / len(first_times):.2f}" if first_times else "-"
+        gap = f"{100 * sum(gaps) / len(gaps):.1f}%" if gaps else "-"
+        print(f"> {profile:<14} {len(solved):>6} {num_optimal:>7} {first_time:>18} {gap:>8} {total_time:>9.2f}")
+
+# WATCH ================================================================================================================
+
+def file_version(filename: str) -> tuple[int, int, int] | None:
+    # - counter.py replaces the file by a rename, the inode changes along with the time
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def wait_for_change(filename: str, version: tuple | None, interval: float, debounce: float) -> tuple:
+    # - Polls until the file differs from version, then until it stays unchanged for debounce seconds,
+    #   or WATCH_DEBOUNCE_LIMIT times as long when it keeps changing
+    while (current := file_version(filename)) == version or current is None:
+        time.sleep(interval)
+    t_first = t_changed = time.time()
+    while time.time() - t_changed < debounce and time.time() - t_first < WATCH_DEBOUNCE_LIMIT * debounce:
+        time.sleep(interval)
+        if (newer := file_version(filename)) != current and newer is not None:
+            current, t_changed = newer, time.time()
+    return current
+
+
+def cancel_on_change(filename: str, version: tuple, interval: float, stop: threading.Event):
+    while not stop.wait(interval):
+        if file_version(filename) != version:
+            _cancel.set()
+            return
+
+
+def replace_outputs(args: argparse.Namespace, solutions: list[Solution], config: dict, jobs: int):
+    # - Written aside and renamed over the outputs, whoever opens them never finds one half-written
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    with tempfile.TemporaryDirectory(prefix=".distribute-", dir=output_dir) as directory:
+        staged = argparse.Namespace(**vars(args))
+        staged.output = os.path.join(directory, os.path.basename(args.output))
+        staged.json = None if args.json is None else f"{args.json}.tmp"
+        write_outputs(staged, solutions, config, jobs)
+        renames = [(os.path.join(directory, name), os.path.join(output_dir, name)) for name in os.listdir(directory)]
+        if args.json is not None:
+            renames.append((staged.json, args.json))
+        for source, destination in renames:
+            try:
+                os.replace(source, destination)
+            except OSError as e:
+                print(f"[{destination}] cannot be replaced, it is probably open in another program: {e}")
+
+
+def watch(args: argparse.Namespace, config: dict, jobs: int, options: SolverOptions, cache: SolutionCache | None,
+          previous: list[Solution] | None):
+    # - Each change of the counts repairs the points affected by it from their last distributions, keeping the others.
+    #   Any changed count of a listed Kruh affects every point. Newer counts arriving during the solve cancel it,
+    #   it starts again once they settle.
+    if args.load is not None:
+        print("--watch solves the counts, it cannot be used with --load")
+        sys.exit(1)
+
+    set_cancel_event(multiprocessing.Event())
+    known: dict[tuple[int, int], tuple[str, Solution]] = {}
+    version = None
+    print(f"Watching [{args.counts}], Ctrl+C to stop")
+    try:
+        while True:
+            version = wait_for_change(args.counts, version, args.watch_interval, args.watch_debounce)
+            try:
+                counts = read_counts(args.counts)
+            except (OSError, ValueError) as e:
+                print(f"[{args.counts}] cannot be read: {e}")
+                continue
+
+            kruhy = make_kruhy(counts, config)
+            points = list(itertools.product(config["Possible Teams counts"], config["Possible Teams sizes"]))
+            affected = [point for point in points
+                        if point not in known or known[point][0] != SolutionCache.key(kruhy, config, *point, options)]
+            print(f"[{time.strftime('%H:%M:%S')}] {sum(kruh.count for kruh in kruhy)} people in {len(kruhy)} Kruhy, "
+                  f"{len(affected)} of {len(points)} points affected")
+            if not affected:
+                continue
+
+            _cancel.clear()
+            stop = threading.Event()
+            watcher = threading.Thread(target=cancel_on_change,
+                                       args=(args.counts, version, args.watch_interval, stop), daemon=True)
+            watcher.start()
+            t_start = time.time()
+            with instrument.span("compute distributions"):
+                solutions = compute_distributions(counts, config, jobs, options, cache, previous, args.time_budget, known)
+            stop.set()
+            watcher.join()
+            if cancelled():
+                continue
+            if any(solution.interrupted or solution.note == "not solved, interrupted" for solution in solutions):
+                raise KeyboardInterrupt
+
+            with instrument.span("write outputs"):
+                replace_outputs(args, solutions, config, jobs)
+            print(f"Distributions written in {time.time() - t_start:.2f}s")
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
 # MAIN =================================================================================================================
 
-def main(args: argparse.Namespace):
-    config = read_config(args.config)
-    counts = read_counts(args.counts)
+def run(args: argparse.Namespace, config: dict, counts: dict[int, int]) -> list[Solution] | None:
+    # - Split from main, so that the service can run jobs on the inputs it already holds
+    if args.model_size:
+        report_model_sizes(counts, config)
+        return None
+
+    jobs = max(1, args.jobs)
+    profile = args.solver_profile or SolverProfile(config.get("Solver profile", SolverProfile.DEFAULT))
+    options = SolverOptions(num_workers=args.threads or 0, jobs=jobs, formulation=args.formulation, engine=args.engine,
+                            profile=profile,
+                            objective=args.objective,
+                            balance_subteams=args.balance_subteams,
+                            warm_start=not args.no_warm_start,
+                            prune=not args.no_prune,
+                            max_moves=args.max_moves,
+                            gap_limit=args.gap_limit,
+                            progress=args.progress,
+                            progress_log=args.progress_log,
+                            incumbent_dir=args.incumbent_dir,
+                            snapshot_dir=args.snapshot_dir,
+                            snapshot_hard=args.snapshot_hard)
+
+    if args.compare_profiles:
+        compare_profiles(counts, config, jobs, options)
+        return None
+
+    cache = None
+    if not args.no_cache:
+        cache = SolutionCache(args.cache_dir, args.cache_max_age * 24 * 3600, int(args.cache_max_size * 1024 * 1024))
+
+    previous = None
+    if args.previous is not None:
+        previous = read_solutions(args.previous, config)
+
+    if args.watch:
+        watch(args, config, jobs, options, cache, previous)
+        return None
+
+    if args.load is not None:
+        with instrument.span("load distributions"):
+            solutions = read_solutions(args.load, config)
+    else:
+        with instrument.span("compute distributions"):
+            solutions = compute_distributions(counts, config, jobs, options, cache, previous, args.time_budget)
+    write_outputs(args, solutions, config, jobs)
+    return solutions
 
-    solutions = compute_distributions(counts, config)
-    write_solutions(args.output, solutions, config)
+
+def write_outputs(args: argparse.Namespace, solutions: list[Solution], config: dict, jobs: int):
+    for output_format in args.format:
+        writer = SOLUTION_WRITERS[output_format]
+        if output_format == OutputFormat.XLSX:
+            writer = functools.partial(writer, static_totals=args.static_totals, per_point=args.workbook_per_point,
+                                       jobs=jobs)
+        with instrument.span(f"write {output_format}"):
+            writer(output_filename(args.output, output_format), solutions, config)
+    if args.json is not None:
+        with instrument.span("write JSON"):
+            write_solutions_json(args.json, solutions)
+
+
+def main(args: argparse.Namespace):
+    with instrument.span("read input"):
+        config = read_config(args.config)
+        # - Loaded distributions need no counts, the watch mode reads them itself
+        counts = read_counts(args.counts) if args.load is None and not args.watch else {}
+    run(args, config, counts)
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
     # args = parser.parse_args(["--counts", "test_counts.json"])
-    main(args)
+    instrument.start(args)
+    try:
+        main(args)
+    finally:
+        instrument.finish()
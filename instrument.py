@@ -0,0 +1,122 @@
+import argparse
+import cProfile
+import pstats
+import threading
+import time
+from dataclasses import dataclass, field
+
+
+# - Shared by the scripts: nested timing spans and counters, printed as a tree with --profile.
+#   Disabled (the default), span() returns a shared no-op context and count() returns immediately.
+#   Each thread nests the spans in its own stack, the spans opened outside the main thread are attached to the root.
+
+
+@dataclass
+class Span:
+    name: str
+    time: float = 0  # seconds, summed over the calls
+    calls: int = 0
+    counters: dict[str, int] = field(default_factory=dict)
+    children: dict[str, "Span"] = field(default_factory=dict)
+
+    def __enter__(self) -> "Span":
+        with _lock:
+            self.calls += 1
+        _stack().append((self, time.perf_counter()))
+        return self
+
+    def __exit__(self, *exc_info):
+        _, t_start = _stack().pop()
+        with _lock:
+            self.time += time.perf_counter() - t_start
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+_enabled = False
+_root = Span("total")
+_local = threading.local()
+_lock = threading.Lock()
+_profiler: cProfile.Profile = None
+_stats_file: str = None
+
+
+def _stack() -> list[tuple[Span, float]]:
+    # - The open spans of the current thread with their start times
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _current() -> Span:
+    stack = _stack()
+    return stack[-1][0] if stack else _root
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--profile", action="store_true",
+                        help="print where the time was spent (a tree of timed spans with counters)")
+    parser.add_argument("--profile-stats", type=str, default=None,
+                        help="also write cProfile statistics to this file (see pstats)")
+
+
+def start(args: argparse.Namespace):
+    global _enabled, _profiler, _stats_file
+    if not args.profile and args.profile_stats is None:
+        return
+    _enabled = True
+    _root.__enter__()
+    if args.profile_stats is not None:
+        _stats_file = args.profile_stats
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def finish():
+    if not _enabled:
+        return
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_stats_file)
+    while _stack():  # - the root and the spans left open by an exception
+        _stack()[-1][0].__exit__()
+    print("Profile:")
+    report(_root)
+    if _stats_file is not None:
+        print(f"cProfile statistics written to [{_stats_file}], top functions:")
+        pstats.Stats(_stats_file).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(10)
+
+
+def span(name: str) -> Span | _NoSpan:
+    # - Spans of the same name under the same parent are merged, their time and calls summed
+    if not _enabled:
+        return _NO_SPAN
+    parent = _current()
+    with _lock:
+        if name not in parent.children:
+            parent.children[name] = Span(name)
+        return parent.children[name]
+
+
+def count(name: str, value: int = 1):
+    if not _enabled:
+        return
+    counters = _current().counters
+    with _lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def report(node: Span, depth: int = 0):
+    calls = f" x{node.calls}" if node.calls > 1 else ""
+    counters = "".join(f", {name} {value}" for name, value in node.counters.items())
+    share = f" {100 * node.time / _root.time:5.1f}%" if _root.time > 0 else ""
+    print(f"{'  ' * depth}> {node.name:<{40 - 2 * depth}} {node.time:9.3f}s{share}{calls}{counters}")
+    for child in node.children.values():
+        report(child, depth + 1)
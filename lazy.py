@@ -0,0 +1,19 @@
+import importlib.util
+import sys
+from types import ModuleType
+
+
+# - Heavy libraries are imported on the first access of their attributes, so that short runs
+#   (and the code paths which do not need them) do not pay for their startup
+
+
+def lazy_import(name: str) -> ModuleType:
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,150 @@
+import argparse
+from dataclasses import replace
+import glob
+import json
+import os
+import sys
+import time
+
+import tabulate
+
+import distribute
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("snapshots", type=str, nargs="+",
+                    help="snapshot .json files written by distribute.py --snapshot-dir, or directories of them")
+parser.add_argument("--engine", type=distribute.Engine, choices=list(distribute.Engine), default=None)
+parser.add_argument("--formulation", type=distribute.Formulation, choices=list(distribute.Formulation), default=None)
+parser.add_argument("--objective", type=distribute.Objective, choices=list(distribute.Objective), default=None)
+parser.add_argument("--balance-subteams", action=argparse.BooleanOptionalAction, default=None)
+parser.add_argument("--solver-profile", type=distribute.SolverProfile, choices=list(distribute.SolverProfile), default=None)
+parser.add_argument("--time-limit", type=float, default=None,
+                    help="seconds per snapshot (default: the time limit it was solved with)")
+parser.add_argument("--threads", type=int, default=None,
+                    help="CP-SAT search workers (default: as solved)")
+parser.add_argument("--gap-limit", type=float, default=None)
+parser.add_argument("--rebuild", action="store_true",
+                    help="build the model again from the snapshot Kruhy even when the model options are unchanged")
+parser.add_argument("--check-hint", action="store_true",
+                    help="also check that the hint of each stored model is feasible, solving it with the hinted values fixed")
+parser.add_argument("--json", type=str, default=None,
+                    help="write the recorded and replayed results to this JSON file")
+
+
+# - Snapshots are replayed in two ways: the stored model is solved as it is, under other solver parameters,
+#   or, once an option changing the model is given, the model is built again from the stored Kruhy split
+
+
+def find_snapshots(paths: list[str]) -> list[str]:
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames += sorted(filename for filename in glob.glob(os.path.join(path, "snapshot-*.json"))
+                                if not filename.endswith(".tmp.json"))
+        else:
+            filenames.append(path)
+    return filenames
+
+
+def replay_options(metadata: dict, args: argparse.Namespace) -> distribute.SolverOptions:
+    options = distribute.snapshot_options(metadata)
+    overrides = {
+        "engine": args.engine,
+        "formulation": args.formulation,
+        "objective": args.objective,
+        "balance_subteams": args.balance_subteams,
+        "profile": args.solver_profile,
+        "time_limit": args.time_limit,
+        "num_workers": args.threads,
+        "gap_limit": args.gap_limit,
+    }
+    return replace(options, **{name: value for name, value in overrides.items() if value is not None})
+
+
+def replay_model(metadata: dict, options: distribute.SolverOptions) -> dict:
+    model = distribute.snapshot_model(metadata)
+    solver = distribute.make_solver(options)
+    t_start = time.time()
+    status, interrupted = distribute.solve_interruptible(solver, model)
+    result = {"status": distribute.Solution.Status(status).name, "objective": None, "bound": None,
+              "time": time.time() - t_start, "interrupted": interrupted}
+    if status in {distribute.cp_model.OPTIMAL, distribute.cp_model.FEASIBLE}:
+        result |= {"objective": solver.objective_value, "bound": solver.best_objective_bound}
+    return result
+
+
+def replay_rebuild(metadata: dict, options: distribute.SolverOptions) -> dict:
+    kruhy, kruhy_friends, hint, config = distribute.snapshot_instance(metadata)
+    num_teams, max_subteam_size = metadata["point"]
+    t_start = time.time()
+    solution = distribute.ENGINES[options.engine](num_teams, max_subteam_size, kruhy, kruhy_friends, config, options, hint)
+    return {"status": solution.status.name, "objective": solution.objective, "bound": solution.bound,
+            "time": time.time() - t_start, "interrupted": solution.interrupted}
+
+
+def check_hint(metadata: dict, options: distribute.SolverOptions) -> str:
+    # - With the hinted variables fixed, the solver finds a solution exactly when the hint is (part of) one
+    model = distribute.snapshot_model(metadata)
+    if not model.proto.solution_hint.vars:
+        return "-"
+    solver = distribute.make_solver(options)
+    solver.parameters.fix_variables_to_their_hinted_value = True
+    status, _ = distribute.solve_interruptible(solver, model)
+    return distribute.Solution.Status(status).name
+
+
+def format_value(value: float | None) -> str:
+    return "-" if value is None else f"{value:g}"
+
+
+def main(args: argparse.Namespace):
+    filenames = find_snapshots(args.snapshots)
+    if not filenames:
+        print("No snapshots found")
+        sys.exit(1)
+
+    rows = []
+    results = []
+    for filename in filenames:
+        try:
+            metadata = distribute.read_snapshot(filename)
+        except (OSError, ValueError) as e:
+            print(f"Skipping [{filename}]: {e}")
+            continue
+        options = replay_options(metadata, args)
+        rebuild = args.rebuild or options.signature() != metadata["solver"]
+        # - The stored model is compared with its first stage, a rebuilt one with the whole recorded solve
+        recorded = metadata["result"] if rebuild else metadata["model_result"] | {"time": None}
+        recorded = {name: value for name, value in recorded.items() if name != "distribution"}
+        replayed = replay_rebuild(metadata, options) if rebuild else replay_model(metadata, options)
+        hint = check_hint(metadata, options) if args.check_hint else None
+
+        num_teams, max_subteam_size = metadata["point"]
+        print(f"> [{os.path.basename(filename)}] #Teams={num_teams}, MaxSubteamSize={max_subteam_size}: "
+              f"{replayed['status']} in {replayed['time']:.2f}s")
+        rows.append([os.path.basename(filename), "rebuild" if rebuild else "model",
+                     recorded["status"], format_value(recorded["objective"]), format_value(recorded["bound"]),
+                     replayed["status"], format_value(replayed["objective"]), format_value(replayed["bound"]),
+                     f"{replayed['time']:.2f}"] + ([hint] if args.check_hint else []))
+        results.append({"snapshot": filename, "rebuild": rebuild, "options": options.signature(),
+                        "recorded": recorded, "replayed": replayed} | ({"hint": hint} if args.check_hint else {}))
+        if replayed["interrupted"]:
+            print("Interrupted")
+            break
+
+    print(tabulate.tabulate(rows, headers=["Snapshot", "Mode", "Recorded", "Objective", "Bound",
+                                           "Replayed", "Objective", "Bound", "Time [s]"] + (["Hint"] if args.check_hint else []),
+                            tablefmt="simple", disable_numparse=True))
+    num_optimal = sum(result["replayed"]["status"] == "OPTIMAL" for result in results)
+    total_time = sum(result["replayed"]["time"] for result in results)
+    print(f"{len(results)} snapshots replayed, {num_optimal} optimal, {total_time:.2f}s in total")
+
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf8") as file:
+            json.dump({"results": results}, file, indent=4, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,166 @@
+import argparse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import time
+import traceback
+
+import distribute
+import timesheet
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--host", type=str, default="127.0.0.1",
+                    help="address to listen on, keep it local, jobs write files on this machine")
+parser.add_argument("--port", type=int, default=8765)
+parser.add_argument("--no-warm-up", action="store_true",
+                    help="do not import the solver and the workbook writer at startup")
+
+
+INPUTS_CACHED = 16
+
+
+# INPUTS ===============================================================================================================
+
+class InputCache:
+    # - Parsed inputs kept by path and kind (config, counts), read again once the file changes
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: dict[tuple[str, str], tuple[tuple, object]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: str, kind: str, read):
+        key = (os.path.abspath(path), kind)
+        stat = os.stat(key[0])
+        version = (stat.st_mtime_ns, stat.st_size)
+        if key in self.entries and self.entries[key][0] == version:
+            self.hits += 1
+            return self.entries[key][1]
+        self.misses += 1
+        value = read(key[0])
+        self.entries.pop(key, None)
+        if len(self.entries) >= self.max_size:
+            del self.entries[next(iter(self.entries))]
+        self.entries[key] = (version, value)
+        return value
+
+
+_inputs = InputCache(INPUTS_CACHED)
+_jobs = 0
+_t_start = time.time()
+
+# JOBS =================================================================================================================
+
+def run_distribute(job_args: list[str]) -> dict:
+    args = distribute.parser.parse_args(job_args)
+    if args.watch:
+        raise ValueError("--watch never returns, run distribute.py on its own")
+    config = _inputs.get(args.config, "config", distribute.read_config)
+    counts = _inputs.get(args.counts, "counts", distribute.read_counts) if args.load is None else {}
+    solutions = distribute.run(args, config, counts)
+    if solutions is None:
+        return {}
+    return {
+        "outputs": {output_format: os.path.abspath(distribute.output_filename(args.output, output_format))
+                    for output_format in args.format},
+        "json": os.path.abspath(args.json) if args.json is not None else None,
+        "solutions": [distribute.solution_to_dict(solution) for solution in solutions],
+    }
+
+
+def run_timesheet(job_args: list[str]) -> dict:
+    args = timesheet.parser.parse_args(job_args)
+    timetables = [(timesheet.output_filename(args.output, config_file, len(args.config)),
+                   _inputs.get(config_file, "config", timesheet.parse_config))
+                  for config_file in args.config]
+    timesheet.construct_timetables(timetables, args.jobs)
+    return {"outputs": [os.path.abspath(workbook_file) for workbook_file, _ in timetables]}
+
+
+def status() -> dict:
+    return {
+        "jobs": _jobs,
+        "uptime": time.time() - _t_start,
+        "inputs cached": len(_inputs.entries),
+        "input hits": _inputs.hits,
+        "input misses": _inputs.misses,
+        "models cached": len(distribute._parametric_models),
+    }
+
+
+JOBS = {
+    "/distribute": run_distribute,
+    "/timesheet": run_timesheet,
+}
+
+# SERVER ===============================================================================================================
+
+class Handler(BaseHTTPRequestHandler):
+    def send_json(self, code: int, body: dict):
+        data = json.dumps(body, ensure_ascii=False).encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_json(404, {"error": f"Unknown path [{self.path}]"})
+            return
+        self.send_json(200, status())
+
+    def do_POST(self):
+        global _jobs
+        if self.path not in JOBS:
+            self.send_json(404, {"error": f"Unknown path [{self.path}], choose from: {', '.join(JOBS)}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job_args = request.get("args", [])
+            if not isinstance(job_args, list) or not all(isinstance(arg, str) for arg in job_args):
+                raise ValueError("\"args\" must be a list of strings")
+        except ValueError as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+
+        _jobs += 1
+        t_start = time.time()
+        try:
+            result = JOBS[self.path](job_args)
+        except SystemExit as e:
+            # - The scripts exit on invalid arguments and unwritable outputs, the message went to the console
+            self.send_json(500, {"error": f"Job exited with code {e.code}"})
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self.send_json(200, result | {"time": time.time() - t_start})
+
+
+def warm_up():
+    # - The imports are lazy, touching them here moves their cost out of the first job
+    distribute.cp_model.CpModel()
+    distribute.xlsxwriter.Workbook
+
+
+def main(args: argparse.Namespace):
+    if not args.no_warm_up:
+        t_start = time.time()
+        warm_up()
+        print(f"Warmed up in {time.time() - t_start:.2f}s")
+    server = HTTPServer((args.host, args.port), Handler)
+    print(f"Serving on http://{args.host}:{args.port}, jobs: {', '.join(JOBS)}, GET /status")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
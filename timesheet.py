@@ -1,17 +1,25 @@
+from __future__ import annotations
 import argparse
+import concurrent.futures
 import datetime
 import itertools
 import json
+import os
 import sys
 
-import xlsxwriter
-import xlsxwriter.exceptions
-import xlsxwriter.worksheet
+import instrument
+from lazy import lazy_import
+
+xlsxwriter = lazy_import("xlsxwriter")
 
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--config", type=str, default="config.json")
+parser.add_argument("--config", type=str, nargs="+", default=["config.json"],
+                    help="configs of the timetables, several build one timetable each (named OUTPUT-CONFIG.xlsx)")
 parser.add_argument("--output", type=str, default="timesheet.xlsx")
+parser.add_argument("--jobs", type=int, default=1,
+                    help="number of timetables built concurrently (processes)")
+instrument.add_arguments(parser)
 
 
 TEAM_FORMAT = "{team} {subteam}"
@@ -80,18 +88,18 @@ class Format:
         "bg_color": "#cacaca",
     }
 
-    @staticmethod
-    def init(workbook: xlsxwriter.Workbook, config):
-        Format.activities = workbook.add_format(Format._activities)
-        Format.time_blocks = workbook.add_format(Format._time_blocks)
-        Format.team_all = workbook.add_format(Format._team_all)
-        Format.team_split_subteams = [
+    def __init__(self, workbook: xlsxwriter.Workbook, config):
+        # - Formats belong to their workbook, each workbook gets its own instance
+        self.activities = workbook.add_format(Format._activities)
+        self.time_blocks = workbook.add_format(Format._time_blocks)
+        self.team_all = workbook.add_format(Format._team_all)
+        self.team_split_subteams = [
             [workbook.add_format(fmt | {"bg_color": subteam["Color"]})
              for fmt in [Format._team_split_top, Format._team_split_bottom, Format._team_split_top, Format._team_split_bottom]]
             for subteam in config["Subteams"]
         ]
-        Format.team_rest = workbook.add_format(Format._team_rest)
-        Format.team_empty = workbook.add_format(Format._team_empty)
+        self.team_rest = workbook.add_format(Format._team_rest)
+        self.team_empty = workbook.add_format(Format._team_empty)
 
 
 def die(message: str):
@@ -109,6 +117,7 @@ def write_merged_sequence(worksheet: xlsxwriter.worksheet.Worksheet, structure,
     cells = [(structure.start_row + i_row * structure.jump_row,
               structure.start_col + i_col * structure.jump_col)
              for i_row, i_col in zip(range(len(data)), range(len(data)))]
+    instrument.count("cells", len(cells))
     for datum, (row, col) in zip(data, cells):
         if structure.jump_row <= 1 and structure.jump_col <= 1:
             worksheet.write(row, col, datum, format)
@@ -133,14 +142,14 @@ def set_timetable_dimensions(timetable, config):
                          Structure.TimeBlocks.column_width)
 
 
-def build_activites(worksheet, config):
+def build_activites(worksheet, config, formats: Format):
     num_activities = config["Activities count"]
     activities = config["Activities"][:num_activities]
     activities_names = [activity["Name"] for activity in activities]
-    write_merged_sequence(worksheet, Structure.Activities, activities_names, Format.activities)
+    write_merged_sequence(worksheet, Structure.Activities, activities_names, formats.activities)
 
 
-def build_timeblocks(worksheet, config):
+def build_timeblocks(worksheet, config, formats: Format):
     time_start = datetime.datetime.strptime(config["Time"]["Start"], "%H:%M")
     activity_duration_str = config["Time"]["Activity duration"]
     activity_duration_m, activity_duration_s = map(int, activity_duration_str.split(':'))
@@ -149,10 +158,10 @@ def build_timeblocks(worksheet, config):
 
     time_blocks = [time_start + i * activity_duration for i in range(num_activities)]
     time_blocks = [block.strftime("%H:%M") for block in time_blocks]
-    write_merged_sequence(worksheet, Structure.TimeBlocks, time_blocks, Format.time_blocks)
+    write_merged_sequence(worksheet, Structure.TimeBlocks, time_blocks, formats.time_blocks)
 
 
-def build_teams(worksheet: xlsxwriter.worksheet.Worksheet, config):
+def build_teams(worksheet: xlsxwriter.worksheet.Worksheet, config, formats: Format):
     def unique_splits():
         splits = []
         all = set(range(1, num_subteams))
@@ -203,14 +212,16 @@ def build_teams(worksheet: xlsxwriter.worksheet.Worksheet, config):
                 row_max = row + Structure.Activities.jump_row - (1 if Structure.Activities.jump_row > 0 else 0)
                 col_max = col + Structure.TimeBlocks.jump_col - (1 if Structure.TimeBlocks.jump_col > 0 else 0)
                 fmt = {
-                    "all": Format.team_all,
-                    "rest": Format.team_rest,
+                    "all": formats.team_all,
+                    "rest": formats.team_rest,
                 }[activity_type]
                 worksheet.merge_range(row, col, row_max, col_max, teams_names[i_team], cell_format=fmt)
+                instrument.count("merged ranges")
             elif activity_type == "split":
                 split = splits[split_counter % len(splits)]
                 for i_subteam in range(num_subteams):
-                    worksheet.write(row + i_subteam, col, team[split[i_subteam]], Format.team_split_subteams[split[i_subteam]][i_subteam])
+                    worksheet.write(row + i_subteam, col, team[split[i_subteam]], formats.team_split_subteams[split[i_subteam]][i_subteam])
+                instrument.count("cells", num_subteams)
                 split_counter += 1
             else:
                 raise ValueError(f"Unrecognized activity type [{activity_type}]")
@@ -222,32 +233,65 @@ def build_teams(worksheet: xlsxwriter.worksheet.Worksheet, config):
             col = Structure.TimeBlocks.start_col + i_activity * Structure.TimeBlocks.jump_col
             row_max = row + Structure.Activities.jump_row - (1 if Structure.Activities.jump_row > 0 else 0)
             col_max = col + Structure.TimeBlocks.jump_col - (1 if Structure.TimeBlocks.jump_col > 0 else 0)
-            worksheet.merge_range(row, col, row_max, col_max, None, Format.team_empty)
+            worksheet.merge_range(row, col, row_max, col_max, None, formats.team_empty)
+            instrument.count("merged ranges")
 
 
 def construct_timetable(workbook_file: str, config: dict):
     workbook = xlsxwriter.Workbook(workbook_file)
-    Format.init(workbook, config)
+    formats = Format(workbook, config)
 
     timetable = workbook.add_worksheet("Timetable")
 
     set_timetable_dimensions(timetable, config)
 
-    build_activites(timetable, config)
-    build_timeblocks(timetable, config)
-    build_teams(timetable, config)
+    with instrument.span("activities"):
+        build_activites(timetable, config, formats)
+    with instrument.span("time blocks"):
+        build_timeblocks(timetable, config, formats)
+    with instrument.span("teams"):
+        build_teams(timetable, config, formats)
 
     try:
-        workbook.close()
+        with instrument.span("close (compression)"):
+            workbook.close()
     except xlsxwriter.exceptions.FileCreateError:
         die(f"[{workbook_file}] cannot be written. It is probably open in another program.")
 
 
+def construct_timetables(timetables: list[tuple[str, dict]], jobs: int = 1):
+    # - Independent workbooks, built in parallel processes (xlsxwriter holds the interpreter lock)
+    if jobs <= 1 or len(timetables) <= 1:
+        for workbook_file, config in timetables:
+            construct_timetable(workbook_file, config)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(construct_timetable, workbook_file, config) for workbook_file, config in timetables]
+        for future in futures:
+            future.result()
+
+
+def output_filename(output: str, config_file: str, num_configs: int) -> str:
+    # - With several configs, each timetable is named by its config
+    if num_configs == 1:
+        return output
+    config_name = os.path.splitext(os.path.basename(config_file))[0]
+    return f"{os.path.splitext(output)[0]}-{config_name}.xlsx"
+
+
 def main(args: argparse.Namespace):
-    config = parse_config(args.config)
-    construct_timetable(args.output, config)
+    with instrument.span("read config"):
+        configs = [parse_config(config_file) for config_file in args.config]
+    timetables = [(output_filename(args.output, config_file, len(args.config)), config)
+                  for config_file, config in zip(args.config, configs)]
+    with instrument.span("construct timetable"):
+        construct_timetables(timetables, args.jobs)
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    main(args)
+    instrument.start(args)
+    try:
+        main(args)
+    finally:
+        instrument.finish()